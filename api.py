@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import labs
+import models
+import usage
+from corpus import PDF_PATH, open_corpus
+
+# =============================================================================
+# HEADLESS LAB API
+# =============================================================================
+# A small HTTP/1.1 service exposing the same content and grounded labs as the
+# Streamlit UI. It attaches to the same memory-mapped corpus store and SQLite
+# response cache, so UI and API processes on one host share both.
+#
+#   GET  /health
+#   GET  /content                          modules and section summaries
+#   GET  /content/<view>/<index>           one section (theory + lab)
+#   POST /labs/<view>/<index>/run          {"input": str, "task": str?, "stream": bool?,
+#                                           "session_id": str?, "cohort": str?}
+#
+# Token budgets (usage.py) are charged to session_id / cohort from the body or
+# the X-Session-Id / X-Cohort headers. Calls without a session id share one
+# anonymous budget, and cohorts not listed in usage_budgets.json count as the
+# default cohort. Degraded answers carry a "notice".
+#
+# Streaming responses (?stream=1 or "stream": true) are chunked NDJSON: zero or
+# more {"delta": text} lines ({"escalate": model} when the cascade moves up a
+# tier) followed by one {"result": {...}} line.
+
+MAX_BODY_BYTES = 256 * 1024
+
+PDF_PAGES = open_corpus(PDF_PATH)
+CONTENT = labs.build_content_from_pdf(PDF_PAGES)
+
+
+def _content_index() -> dict:
+    return {
+        view: {
+            "module_title": mod["module_title"],
+            "module_desc": mod["module_desc"],
+            "time": mod["time"],
+            "sections": [
+                {"index": i, "name": sec["name"], "icon": sec["icon"], "time": sec["time"],
+                 "module_type": sec["lab"]["module_type"]}
+                for i, sec in enumerate(mod["sections"])
+            ],
+        }
+        for view, mod in CONTENT.items()
+    }
+
+
+class LabRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive by default
+    server_version = "ExcelAILabs/1.0"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    # --- Responses ---
+    def _send_json(self, status: int, payload: dict) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, events) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            for event in events:
+                line = (json.dumps(event) + "\n").encode("utf-8")
+                self.wfile.write(f"{len(line):X}\r\n".encode("ascii") + line + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        finally:
+            # On a dropped connection this stops the model call and charges what it used.
+            events.close()
+
+    def _error(self, status: int, message: str) -> None:
+        self._send_json(status, {"error": message})
+
+    def _route(self) -> tuple[list[str], dict]:
+        url = urlparse(self.path)
+        return [p for p in url.path.split("/") if p], parse_qs(url.query)
+
+    def _section(self, view: str, index: str) -> dict | None:
+        try:
+            return labs.get_section(CONTENT, view, int(index))
+        except ValueError:
+            return None
+
+    def _read_json(self) -> dict | None:
+        # Sends the error response itself and returns None on failure. A body
+        # that is not read in full closes the connection, so its bytes are never
+        # parsed as the next request on a keep-alive connection.
+        raw_length = (self.headers.get("Content-Length") or "0").strip()
+        if not (raw_length.isascii() and raw_length.isdigit()):
+            self.close_connection = True
+            self._error(400, "Invalid Content-Length")
+            return None
+        length = int(raw_length)
+        if length > MAX_BODY_BYTES:
+            self.close_connection = True
+            self._error(413, f"Body exceeds {MAX_BODY_BYTES} bytes")
+            return None
+        raw = self.rfile.read(length) if length else b""
+        if len(raw) < length:
+            self.close_connection = True
+            return None
+        try:
+            body = json.loads(raw or b"{}")
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            body = None
+        if not isinstance(body, dict):
+            self._error(400, "Body must be a JSON object")
+            return None
+        return body
+
+    # --- Routes ---
+    def do_GET(self):
+        parts, _ = self._route()
+        if parts == ["health"]:
+            self._send_json(200, {"status": "ok", "pages": len(PDF_PAGES), "backend": models.MODEL_BACKEND})
+        elif parts == ["content"]:
+            self._send_json(200, _content_index())
+        elif len(parts) == 3 and parts[0] == "content":
+            section = self._section(parts[1], parts[2])
+            if section is None:
+                self._error(404, "Unknown section")
+            else:
+                self._send_json(200, section)
+        else:
+            self._error(404, "Not found")
+
+    def do_POST(self):
+        # Consume the body before any early response so the connection stays in sync.
+        body = self._read_json()
+        if body is None:
+            return
+        parts, query = self._route()
+        if not (len(parts) == 4 and parts[0] == "labs" and parts[3] == "run"):
+            self._error(404, "Not found")
+            return
+        section = self._section(parts[1], parts[2])
+        if section is None:
+            self._error(404, "Unknown section")
+            return
+        user_input = body.get("input")
+        if not isinstance(user_input, str) or not user_input.strip():
+            self._error(400, "'input' is required")
+            return
+
+        lab = section["lab"]
+        task = body.get("task") or lab["task"]
+        args = (lab["role"], task, user_input, lab["format"], lab["module_type"])
+        budget = {
+            "session_id": str(body.get("session_id") or self.headers.get("X-Session-Id") or ""),
+            "cohort": str(body.get("cohort") or self.headers.get("X-Cohort") or usage.DEFAULT_COHORT),
+        }
+        stream = body.get("stream") is True or query.get("stream", ["0"])[0] in ("1", "true")
+        if stream:
+            self._send_stream(labs.stream_gemini(*args, pages=PDF_PAGES, **budget))
+        else:
+            result = labs.call_gemini(*args, pages=PDF_PAGES, **budget)
+            self._send_json(502 if "error" in result else 200, result)
+
+
+class LabServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, verbose: bool = False):
+        self.verbose = verbose
+        super().__init__(address, LabRequestHandler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless HTTP API for the Excel AI labs.")
+    parser.add_argument("--host", default=os.environ.get("LAB_API_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("LAB_API_PORT", "8600")))
+    parser.add_argument("--stub", action="store_true", help="Answer with the local stub model instead of Gemini.")
+    parser.add_argument("--verbose", action="store_true", help="Log every request.")
+    args = parser.parse_args()
+
+    if args.stub:
+        models.MODEL_BACKEND = "stub"
+
+    server = LabServer((args.host, args.port), verbose=args.verbose)
+    print(f"Lab API listening on http://{args.host}:{args.port} ({models.MODEL_BACKEND} backend)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
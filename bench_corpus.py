@@ -0,0 +1,105 @@
+import argparse
+import gc
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from corpus import PDF_PATH, CorpusStore, _write_store, build_sections, extract_pdf_pages, rank_pages
+
+# =============================================================================
+# CORPUS MEMORY BENCHMARK
+# =============================================================================
+# Compares the plain list[str] page layout (re-tokenised per query) with the
+# compact store (one text buffer, offset arrays, interned term ids, postings),
+# both in memory and memory-mapped, at several corpus sizes.
+#
+#   python bench_corpus.py --scales 1,10,50
+
+QUERIES = [
+    "Write an XLOOKUP formula that returns Not found for blanks",
+    "Clean names dates currency and extra spaces with Power Query",
+    "Fix #N/A and #DIV/0 errors with IFERROR",
+    "Build a pivot table and chart of revenue by month",
+    "Rewrite my vague prompt into a precise Excel prompt",
+    "Split full names into first and last name columns",
+    "Find duplicates and missing values with conditional formatting",
+    "Automate a weekly report workflow",
+]
+
+
+def _heap_bytes(build):
+    gc.collect()
+    tracemalloc.start()
+    obj = build()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, used
+
+
+def _query_cost(pages, repeat: int) -> tuple[float, int]:
+    # Mean latency (ms) without tracing, then peak allocation (bytes) per query.
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for q in QUERIES:
+            rank_pages(q, pages)
+    latency_ms = (time.perf_counter() - start) * 1000 / (repeat * len(QUERIES))
+
+    peaks = []
+    for q in QUERIES:
+        gc.collect()
+        tracemalloc.start()
+        rank_pages(q, pages)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return latency_ms, int(statistics.mean(peaks))
+
+
+def bench(base_pages: list[str], scale: int, repeat: int, tmp_dir: str) -> list[dict]:
+    pages = [f"{p}\n(copy {c})" for c in range(scale) for p in base_pages]
+    rows = []
+
+    # Current layout: the strings themselves are the corpus.
+    listed, heap = _heap_bytes(lambda: [p.encode("utf-8").decode("utf-8") for p in pages])
+    latency, peak = _query_cost(listed, repeat)
+    rows.append({"layout": "list[str]", "heap": heap, "file": 0, "latency_ms": latency, "peak": peak})
+
+    store, heap = _heap_bytes(lambda: CorpusStore.from_pages(pages))
+    latency, peak = _query_cost(store, repeat)
+    rows.append({"layout": "store (bytes)", "heap": heap, "file": 0, "latency_ms": latency, "peak": peak})
+    store.close()
+
+    path = os.path.join(tmp_dir, f"bench_{scale}.corpus")
+    _write_store(path, build_sections(pages))
+    mapped, heap = _heap_bytes(lambda: CorpusStore.open(path))
+    latency, peak = _query_cost(mapped, repeat)
+    rows.append({"layout": "store (mmap)", "heap": heap, "file": os.path.getsize(path), "latency_ms": latency, "peak": peak})
+    mapped.close()
+
+    for r in rows:
+        r["pages"] = len(pages)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory benchmark: list[str] pages vs the compact corpus store.")
+    parser.add_argument("--pdf", default=PDF_PATH)
+    parser.add_argument("--scales", default="1,10,50", help="Corpus sizes as multiples of the PDF.")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing passes over the query set.")
+    args = parser.parse_args()
+
+    base_pages = extract_pdf_pages(args.pdf)
+    if not base_pages:
+        raise SystemExit(f"PDF not found: {args.pdf}")
+
+    print(f"{'pages':>6} {'layout':<14} {'heap KiB':>9} {'mmap KiB':>9} {'query ms':>9} {'query peak KiB':>15}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in [int(s) for s in args.scales.split(",") if s.strip()]:
+            for r in bench(base_pages, scale, args.repeat, tmp_dir):
+                print(f"{r['pages']:>6} {r['layout']:<14} {r['heap'] / 1024:>9.0f} {r['file'] / 1024:>9.0f} "
+                      f"{r['latency_ms']:>9.2f} {r['peak'] / 1024:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
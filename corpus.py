@@ -0,0 +1,375 @@
+import hashlib
+import heapq
+import mmap
+import os
+import re
+import struct
+import tempfile
+from array import array
+from collections.abc import Sequence
+
+from pypdf import PdfReader
+
+from storage import private_dir
+
+# =============================================================================
+# CORPUS STORE
+# =============================================================================
+# The cleaned PDF pages and their term index are written once per host into a
+# flat file and every worker process memory-maps it read-only, so the corpus
+# lives in the OS page cache instead of in each process's heap.
+
+PDF_PATH = os.environ.get("MODULE_PDF_PATH", "Module_4_Excel_Data_Analysis_with_AI.pdf")
+CACHE_DIR = os.environ.get(
+    "CORPUS_CACHE_DIR",
+    os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "excel_ai_corpus"),
+)
+
+_MAGIC = b"XLCORP01"
+_FORMAT_VERSION = 3
+_HEADER = struct.Struct("<8sII")          # magic, format version, section count
+_SECTION = struct.Struct("<16sQQ")        # name, byte offset, byte length
+
+
+def _clean_pdf_text(text: str) -> str:
+    text = text.replace("\u00a0", " ")
+    # Remove repeated footer lines like "MODULE 4: ... 12 / 50"
+    text = re.sub(r"MODULE\s+4:\s+EXCEL\s+&\s+DATA\s+ANALYSIS\s+WITH\s+AI\s+\d+\s*/\s*\d+", "", text, flags=re.IGNORECASE)
+    # Remove stray page markers like "1 / 50"
+    text = re.sub(r"\b\d+\s*/\s*\d+\b", "", text)
+    # Collapse weird spacing (e.g., "P A R T" -> "PART")
+    text = re.sub(r"\bP\s+A\s+R\s+T\b", "PART", text)
+    text = re.sub(r"\bM\s+O\s+D\s+U\s+L\s+E\b", "MODULE", text)
+    # Clean extra whitespace
+    text = re.sub(r"[ \t]+", " ", text)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip()
+
+
+def extract_pdf_pages(path: str) -> list[str]:
+    if not os.path.exists(path):
+        return []
+    reader = PdfReader(path)
+    pages = []
+    for p in reader.pages:
+        pages.append(_clean_pdf_text(p.extract_text() or ""))
+    return pages
+
+
+def corpus_version(path: str) -> str:
+    # Changes whenever the PDF (or the on-disk layout) changes, so a stale
+    # store is never attached to.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ""
+    raw = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}|{_FORMAT_VERSION}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def _write_store(store_path: str, sections: dict[str, bytes]) -> None:
+    os.makedirs(os.path.dirname(store_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(store_path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_pack(sections))
+        # Atomic publish: concurrent workers either see no file or a complete one.
+        os.replace(tmp_path, store_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _read_sections(view: memoryview) -> dict[str, memoryview]:
+    # Raises ValueError for anything that is not a complete store of this format
+    # (e.g. a file truncated by a full disk), never struct.error or IndexError.
+    if len(view) < _HEADER.size:
+        raise ValueError("Truncated corpus store header")
+    magic, version, count = _HEADER.unpack_from(view, 0)
+    if magic != _MAGIC or version != _FORMAT_VERSION:
+        raise ValueError("Unrecognised corpus store")
+    table_end = _HEADER.size + count * _SECTION.size
+    if table_end > len(view):
+        raise ValueError("Truncated corpus store section table")
+    # Validate the whole table before slicing, so a failure leaves no views
+    # exported from the buffer (an exported view keeps the mmap from closing).
+    table = [_SECTION.unpack_from(view, _HEADER.size + i * _SECTION.size) for i in range(count)]
+    for name, off, length in table:
+        if off < table_end or off + length > len(view) or not name.rstrip(b"\0").isascii():
+            raise ValueError("Corpus store section out of bounds")
+    return {name.rstrip(b"\0").decode("ascii"): view[off:off + length] for name, off, length in table}
+
+
+_PAGE_SEP = b"\n\n"
+
+
+def build_sections(pages: list[str], tokenize=None) -> dict[str, bytes]:
+    # Layout (all integers are native-endian typed arrays):
+    #   text             pages joined by a blank line, UTF-8
+    #   page_offsets     Q[n+1]  start of each page (+ end of buffer)
+    #   terms            sorted vocabulary, UTF-8, concatenated
+    #   term_offsets     I[v+1]  start of each term in `terms`
+    #   posting_offsets  Q[v+1]  start of each term's postings
+    #   postings         I[...]  ascending page ids per term
+    tokenize = tokenize or _tokenize
+    text = bytearray()
+    page_offsets = array("Q")
+    page_terms = []
+    for page in pages:
+        page_offsets.append(len(text))
+        text += page.encode("utf-8") + _PAGE_SEP
+        page_terms.append(set(tokenize(page)))
+    page_offsets.append(len(text))
+
+    vocab = sorted({t.encode("utf-8") for terms in page_terms for t in terms})
+    term_ids = {t.decode("utf-8"): i for i, t in enumerate(vocab)}
+    postings_by_term = [array("I") for _ in vocab]
+    for page_id, terms in enumerate(page_terms):
+        for t in terms:
+            postings_by_term[term_ids[t]].append(page_id)
+
+    terms = bytearray()
+    term_offsets = array("I", [0])
+    posting_offsets = array("Q", [0])
+    postings = array("I")
+    for t, plist in zip(vocab, postings_by_term):
+        terms += t
+        term_offsets.append(len(terms))
+        postings.extend(plist)
+        posting_offsets.append(len(postings))
+
+    return {
+        "text": bytes(text),
+        "page_offsets": page_offsets.tobytes(),
+        "terms": bytes(terms),
+        "term_offsets": term_offsets.tobytes(),
+        "posting_offsets": posting_offsets.tobytes(),
+        "postings": postings.tobytes(),
+    }
+
+
+def _pack(sections: dict[str, bytes]) -> bytes:
+    table_size = _HEADER.size + _SECTION.size * len(sections)
+    offset = _align(table_size)
+    header = bytearray(_HEADER.pack(_MAGIC, _FORMAT_VERSION, len(sections)))
+    body = bytearray()
+    for name, data in sections.items():
+        header += _SECTION.pack(name.encode("ascii"), offset, len(data))
+        body += b"\0" * (offset - table_size - len(body))
+        body += data
+        offset = _align(offset + len(data))
+    return bytes(header + body)
+
+
+class CorpusStore(Sequence):
+    # Read-only, list-like view of the pages over one packed buffer: a memory
+    # map of the on-disk store, or bytes for an in-process corpus. Pages are
+    # decoded on access and retrieval works on integer term ids and postings,
+    # so nothing is copied into per-page Python objects.
+
+    def __init__(self, buffer, version: str = "", path: str | None = None):
+        self.path = path
+        self.version = version
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._sections = {}
+        self._casts = []
+        try:
+            self._sections = _read_sections(self._view)
+            s = self._sections
+            self._text = s["text"]
+            self._terms = s["terms"]
+            self._page_offsets = self._cast(s["page_offsets"], "Q")
+            self._term_offsets = self._cast(s["term_offsets"], "I")
+            self._posting_offsets = self._cast(s["posting_offsets"], "Q")
+            self._postings = self._cast(s["postings"], "I")
+            # Offsets must be non-empty and stay inside the sections they index.
+            if not (self._page_offsets and self._term_offsets and self._posting_offsets
+                    and self._page_offsets[-1] <= len(self._text)
+                    and self._term_offsets[-1] <= len(self._terms)
+                    and self._posting_offsets[-1] <= len(self._postings)):
+                raise ValueError("Corpus store offsets out of bounds")
+        except (KeyError, TypeError, ValueError) as e:
+            self.close()
+            raise ValueError(f"Corrupt corpus store: {e}") from e
+
+    def _cast(self, view: memoryview, fmt: str) -> memoryview:
+        cast = view.cast(fmt)
+        self._casts.append(cast)
+        return cast
+
+    @classmethod
+    def open(cls, store_path: str, version: str = "") -> "CorpusStore":
+        with open(store_path, "rb") as f:
+            # An empty file raises ValueError here, like any other corrupt store.
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mm, version, store_path)
+
+    @classmethod
+    def from_pages(cls, pages: list[str], tokenize=None) -> "CorpusStore":
+        return cls(_pack(build_sections(pages, tokenize)))
+
+    # --- Pages ---
+    def __len__(self) -> int:
+        return len(self._page_offsets) - 1
+
+    def _span(self, start: int, end: int) -> str:
+        # Bytes from the start of page `start` to the end of page `end`.
+        return str(self._text[self._page_offsets[start]:self._page_offsets[end + 1] - len(_PAGE_SEP)], "utf-8")
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("page index out of range")
+        return self._span(i, i)
+
+    def excerpt(self, start_i: int, end_i: int) -> str:
+        # Pages are stored blank-line separated, so a range is one slice.
+        return self._span(start_i, end_i).strip()
+
+    # --- Term Index ---
+    def term_id(self, term: str) -> int:
+        key = term.encode("utf-8")
+        offs = self._term_offsets
+        lo, hi = 0, len(offs) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(self._terms[offs[mid]:offs[mid + 1]]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(offs) - 1 and self._terms[offs[lo]:offs[lo + 1]] == key:
+            return lo
+        return -1
+
+    def postings(self, term_id: int) -> memoryview:
+        return self._postings[self._posting_offsets[term_id]:self._posting_offsets[term_id + 1]]
+
+    def close(self) -> None:
+        for view in self._casts + list(self._sections.values()):
+            view.release()
+        self._view.release()
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+
+def open_corpus(pdf_path: str, cache_dir: str = CACHE_DIR):
+    if not os.path.exists(pdf_path):
+        return []
+    version = corpus_version(pdf_path)
+    store_path = os.path.join(cache_dir, f"{version}.corpus")
+    for _ in range(2):
+        try:
+            private_dir(cache_dir)
+            if not os.path.exists(store_path):
+                _write_store(store_path, build_sections(extract_pdf_pages(pdf_path)))
+            return CorpusStore.open(store_path, version)
+        except ValueError:
+            # Corrupt or truncated store: remove it and rebuild once.
+            try:
+                os.remove(store_path)
+            except OSError:
+                break
+        except OSError:
+            break
+    # Read-only filesystem, an unsafe cache directory or a store that cannot be
+    # rebuilt: keep a private in-memory copy.
+    return CorpusStore.from_pages(extract_pdf_pages(pdf_path))
+
+
+# =============================================================================
+# RETRIEVAL
+# =============================================================================
+
+# Pages mentioning this term get a fixed score bonus (the labs are about prompting).
+BOOST_TERM = "prompt"
+BOOST_WEIGHT = 2
+
+
+def _tokenize(s: str) -> list[str]:
+    return re.findall(r"[a-zA-Z]{3,}", (s or "").lower())
+
+
+def _rank_indexed(q_set: set[str], store: CorpusStore, k: int, boost: int) -> list[int]:
+    # Same scoring as the scan below (distinct shared terms, plus `boost` for
+    # pages with BOOST_TERM), accumulated from postings instead of per-page sets.
+    scores = array("I", bytes(4 * len(store)))
+    for term in q_set:
+        tid = store.term_id(term)
+        if tid >= 0:
+            for page_id in store.postings(tid):
+                scores[page_id] += 1
+    boost_id = store.term_id(BOOST_TERM) if boost else -1
+    if boost_id >= 0:
+        for page_id in store.postings(boost_id):
+            scores[page_id] += boost
+    # Ties go to the higher page number, as in the scan.
+    return heapq.nlargest(k, (i for i, s in enumerate(scores) if s), key=lambda i: (scores[i], i))
+
+
+def rank_pages(query: str, pages: Sequence[str], k: int = 6, boost: int = BOOST_WEIGHT, tokenize=None) -> list[int]:
+    # A CorpusStore must have been built with the same `tokenize`.
+    tokenize = tokenize or _tokenize
+    if not pages:
+        return []
+    q_tokens = tokenize(query)
+    if not q_tokens:
+        return []
+    q_set = set(q_tokens)
+
+    if isinstance(pages, CorpusStore):
+        picked = _rank_indexed(q_set, pages, k, boost)
+        return picked or list(range(min(k, len(pages))))
+
+    # Plain list of page strings: tokenise every page per query.
+    scored = []
+    for i, text in enumerate(pages):
+        t_tokens = tokenize(text)
+        if not t_tokens:
+            continue
+        t_set = set(t_tokens)
+        score = len(q_set.intersection(t_set))
+        if BOOST_TERM in t_set:
+            score += boost
+        scored.append((score, i))
+
+    scored.sort(reverse=True)
+    picked = [i for score, i in scored[:k] if score > 0]
+    if not picked:
+        picked = list(range(min(k, len(pages))))
+    return picked
+
+
+def format_pages(picked: list[int], pages: Sequence[str], max_chars: int = 7000) -> str:
+    chunks = []
+    total = 0
+    for i in picked:
+        chunk = f"Page {i+1}:\n{pages[i]}\n"
+        if total + len(chunk) > max_chars:
+            break
+        chunks.append(chunk)
+        total += len(chunk)
+
+    return "\n\n".join(chunks).strip()
+
+
+def retrieve_pdf_context(query: str, pages: Sequence[str], k: int = 6, max_chars: int = 7000) -> str:
+    return format_pages(rank_pages(query, pages, k), pages, max_chars)
+
+
+def pages_excerpt(pages: Sequence[str], start_page: int, end_page: int) -> str:
+    if not pages:
+        return "PDF not found. Put the file next to app.py or set MODULE_PDF_PATH."
+    start_i = max(0, start_page - 1)
+    end_i = min(len(pages) - 1, end_page - 1)
+    if isinstance(pages, CorpusStore):
+        return pages.excerpt(start_i, end_i) if start_i <= end_i else ""
+    return "\n\n".join([pages[i] for i in range(start_i, end_i + 1)]).strip()
@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import random
+import re
+import time
+
+from corpus import PDF_PATH, CorpusStore, _tokenize, extract_pdf_pages, format_pages, pages_excerpt, rank_pages
+
+# =============================================================================
+# RETRIEVAL EVALUATION
+# =============================================================================
+# Scores retrieval configurations against retrieval_golden.json (lab queries
+# mapped to the PDF pages they should pull in). For each combination of
+# tokenizer, k, "prompt" boost and backend it reports recall@k, hit rate,
+# MRR and per-query latency. --check verifies that the postings index ranks
+# and excerpts exactly like the plain page scan (run it after any change to
+# the store format or the scoring).
+#
+#   python eval_retrieval.py --ks 3,6,10 --boosts 0,2
+#   python eval_retrieval.py --check
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "retrieval_golden.json")
+
+_STOPWORDS = {
+    "the", "and", "for", "you", "your", "with", "this", "that", "are", "not", "can", "what", "from",
+    "use", "how", "all", "any", "into", "then", "them", "they", "want", "will", "should", "each",
+    "an", "to", "of", "in", "on", "is", "it", "or", "as", "be", "by", "at", "my", "me", "do", "so",
+}
+
+
+def _tokenize_excel(s: str) -> list[str]:
+    # Keeps what the default rule drops: 2-letter words (IF, OR), cell
+    # references (A1, $B$2) and error codes (#N/A, #DIV/0!).
+    return re.findall(r"#[a-z0-9/]+[!?]?|\$?[a-z]{1,3}\$?\d+|[a-z]{2,}", (s or "").lower())
+
+
+def _tokenize_excel_stop(s: str) -> list[str]:
+    return [t for t in _tokenize_excel(s) if t not in _STOPWORDS]
+
+
+TOKENIZERS = {
+    "default": _tokenize,
+    "excel": _tokenize_excel,
+    "excel_stop": _tokenize_excel_stop,
+}
+
+
+def load_golden(path: str = GOLDEN_PATH) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)["queries"]
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def evaluate(golden: list[dict], backend, k: int, boost: int, tokenize) -> dict:
+    recalls, hits, rr, latencies = [], [], [], []
+    misses = []
+    for item in golden:
+        relevant = {p - 1 for p in item["pages"]}
+        start = time.perf_counter()
+        ranked = rank_pages(item["query"], backend, k=k, boost=boost, tokenize=tokenize)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        found = relevant.intersection(ranked)
+        recalls.append(len(found) / len(relevant))
+        hits.append(1.0 if found else 0.0)
+        first = next((rank for rank, page in enumerate(ranked, 1) if page in relevant), None)
+        rr.append(1 / first if first else 0.0)
+        if not found:
+            misses.append(item["id"])
+    n = len(golden)
+    return {
+        "recall": sum(recalls) / n,
+        "hit_rate": sum(hits) / n,
+        "mrr": sum(rr) / n,
+        "p50_ms": _percentile(latencies, 50),
+        "p95_ms": _percentile(latencies, 95),
+        "misses": misses,
+    }
+
+
+def check_equivalence(pages: list[str], golden: list[dict], queries: int = 500, seed: int = 0) -> list[str]:
+    # Index vs scan on the golden queries plus random word bags drawn from the
+    # corpus, for every k/boost/tokenizer; then every pages_excerpt range.
+    rng = random.Random(seed)
+    words = sorted({w for page in pages for w in page.split()})
+    texts = [item["query"] for item in golden]
+    texts += [" ".join(rng.sample(words, rng.randint(1, 12))) for _ in range(queries)]
+    mismatches = []
+    for tok_name, tokenize in TOKENIZERS.items():
+        store = CorpusStore.from_pages(pages, tokenize)
+        for text in texts:
+            for k in (1, 3, 6, 10):
+                for boost in (0, 2):
+                    indexed = rank_pages(text, store, k=k, boost=boost, tokenize=tokenize)
+                    scanned = rank_pages(text, pages, k=k, boost=boost, tokenize=tokenize)
+                    if indexed != scanned or format_pages(indexed, store) != format_pages(scanned, pages):
+                        mismatches.append(f"{tok_name} k={k} boost={boost}: {text[:60]!r}")
+        store.close()
+    store = CorpusStore.from_pages(pages)
+    for start in range(0, len(pages) + 2):
+        for end in range(start, len(pages) + 2):
+            if pages_excerpt(store, start, end) != pages_excerpt(pages, start, end):
+                mismatches.append(f"pages_excerpt({start}, {end})")
+    store.close()
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k / MRR / latency for retrieval configurations.")
+    parser.add_argument("--pdf", default=PDF_PATH)
+    parser.add_argument("--golden", default=GOLDEN_PATH)
+    parser.add_argument("--ks", default="3,6,10")
+    parser.add_argument("--boosts", default="0,2")
+    parser.add_argument("--tokenizers", default=",".join(TOKENIZERS))
+    parser.add_argument("--backends", default="index,scan", help="index (CorpusStore postings) and/or scan (list[str]).")
+    parser.add_argument("--show-misses", action="store_true", help="List queries with no relevant page retrieved.")
+    parser.add_argument("--json", help="Also write results to this path.")
+    parser.add_argument("--check", action="store_true", help="Only check that index and scan agree; exit 1 if not.")
+    parser.add_argument("--check-queries", type=int, default=500, help="Random queries used by --check.")
+    args = parser.parse_args()
+
+    pages = extract_pdf_pages(args.pdf)
+    if not pages:
+        raise SystemExit(f"PDF not found: {args.pdf}")
+    golden = load_golden(args.golden)
+
+    if args.check:
+        mismatches = check_equivalence(pages, golden, args.check_queries)
+        for m in mismatches[:20]:
+            print(f"mismatch: {m}")
+        print(f"index vs scan: {len(mismatches)} mismatches")
+        raise SystemExit(1 if mismatches else 0)
+
+    results = []
+    for tok_name in args.tokenizers.split(","):
+        tokenize = TOKENIZERS[tok_name]
+        backends = {"index": CorpusStore.from_pages(pages, tokenize), "scan": pages}
+        for backend_name in args.backends.split(","):
+            for k in [int(x) for x in args.ks.split(",")]:
+                for boost in [int(x) for x in args.boosts.split(",")]:
+                    r = evaluate(golden, backends[backend_name], k, boost, tokenize)
+                    r.update(tokenizer=tok_name, backend=backend_name, k=k, boost=boost)
+                    results.append(r)
+        backends["index"].close()
+
+    results.sort(key=lambda r: (r["recall"], r["mrr"], -r["p50_ms"]), reverse=True)
+    print(f"{len(golden)} golden queries, {len(pages)} pages  (* = current app setting)")
+    print(f"  {'tokenizer':<11} {'backend':<7} {'k':>3} {'boost':>5} {'recall@k':>9} {'hit@k':>6} {'MRR':>6} "
+          f"{'p50 ms':>7} {'p95 ms':>7}")
+    for r in results:
+        current = r["tokenizer"] == "default" and r["k"] == 6 and r["boost"] == 2
+        print(f"{'*' if current else ' '} {r['tokenizer']:<11} {r['backend']:<7} {r['k']:>3} {r['boost']:>5} "
+              f"{r['recall']:>9.3f} {r['hit_rate']:>6.2f} {r['mrr']:>6.3f} {r['p50_ms']:>7.2f} {r['p95_ms']:>7.2f}")
+        if args.show_misses and r["misses"]:
+            print(f"      misses: {', '.join(r['misses'])}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,796 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import routing
+import usage
+from corpus import CACHE_DIR, format_pages, pages_excerpt, rank_pages, retrieve_pdf_context
+from models import estimate_tokens, is_quota_error, missing_key_error
+from storage import connect_sqlite
+
+# =============================================================================
+# LAB ENGINE
+# =============================================================================
+# Prompt assembly, the response cache and the course content. Shared by the
+# Streamlit UI (app.py) and the headless HTTP service (api.py). Model choice
+# per module_type lives in routing.py.
+
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", os.path.join(CACHE_DIR, "responses.sqlite"))
+RESPONSE_CACHE_MAX_AGE_S = float(os.environ.get("RESPONSE_CACHE_MAX_AGE_DAYS", "30")) * 86400
+RESPONSE_CACHE_MAX_ROWS = int(os.environ.get("RESPONSE_CACHE_MAX_ROWS", "20000"))
+
+CONTEXT_INSTRUCTIONS = {
+    "excel_plan": "Create a step-by-step plan for the Excel/data task, grounded in the training PDF. Include exact menu clicks, cell references, and formula patterns where relevant.",
+    "analysis": "Design an analysis workflow grounded in the training PDF. Suggest pivots, metrics, checks, and how to interpret results. Include at least one actionable recommendation.",
+    "prompt_improve": "Rewrite the user's vague prompt into a precise, high-quality Excel AI prompt (goal, columns, criteria, edge cases, output). Then answer it.",
+    "formula_write": "Write the exact Excel formula needed, with robust blank/error handling and a clear explanation.",
+    "formula_pattern": "Identify the best formula pattern (XLOOKUP, SUMIF(S), COUNTIF(S), IF(S), INDEX/MATCH, dynamic arrays) and provide the best solution with examples.",
+    "formula_fix": "Diagnose the Excel error, explain the root cause, and provide a corrected formula plus safer alternatives (IFERROR/guards).",
+    "cleaning": "Provide a detailed cleaning approach using Excel formulas and/or Power Query. Standardise names, dates, currency, spaces, and data types.",
+    "transform": "Provide the best method to split/combine/extract (formulas, Text to Columns, Flash Fill, Power Query), with step-by-step instructions.",
+    "validate": "Create data-quality checks (duplicates, invalid formats, missing values) and show how to implement them with helper columns and conditional formatting.",
+    "insights": "Extract insights and interpret results. Recommend pivots, charts, and a short narrative summary.",
+    "charts": "Recommend the right chart type and provide exact Excel steps to build and format it so the insight is obvious.",
+    "automation": "Design an end-to-end recurring workflow: import, clean, analyse, chart, and summarise. Include Power Query steps and a reusable prompt library."
+}
+
+DEFAULT_INSTRUCTION = "Solve the user's Excel/data task grounded in the training PDF."
+
+
+# --- Response Cache ---
+# Keyed on the route (models + output caps) and the full prompt (retrieved context included), stored in
+# SQLite next to the corpus store so every UI and API process on a host shares it.
+# Entries expire after RESPONSE_CACHE_MAX_AGE_DAYS, and only the newest RESPONSE_CACHE_MAX_ROWS are kept:
+# pruned when a process first opens the cache and then every _PRUNE_EVERY writes.
+_PRUNE_EVERY = 100
+_cache_puts = 0
+
+
+def _prune_cache(conn: sqlite3.Connection) -> None:
+    conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - RESPONSE_CACHE_MAX_AGE_S,))
+    conn.execute(
+        "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created DESC LIMIT -1 OFFSET ?)",
+        (RESPONSE_CACHE_MAX_ROWS,),
+    )
+
+
+def _cache_connect() -> sqlite3.Connection:
+    return connect_sqlite(
+        RESPONSE_CACHE_PATH,
+        "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body TEXT NOT NULL, created REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS responses_created ON responses (created)",
+        setup=_prune_cache,
+    )
+
+
+def _cache_key(route_signature: str, prompt: str) -> str:
+    return hashlib.sha256(f"{route_signature}\n{prompt}".encode("utf-8")).hexdigest()
+
+
+def cache_get(key: str) -> dict | None:
+    try:
+        with _cache_connect() as conn:
+            row = conn.execute(
+                "SELECT body FROM responses WHERE key = ? AND created >= ?",
+                (key, time.time() - RESPONSE_CACHE_MAX_AGE_S),
+            ).fetchone()
+    except sqlite3.Error:
+        return None
+    return json.loads(row[0]) if row else None
+
+
+def cache_put(key: str, result: dict) -> None:
+    global _cache_puts
+    _cache_puts += 1
+    try:
+        with _cache_connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, body, created) VALUES (?, ?, ?)",
+                (key, json.dumps(result), time.time()),
+            )
+            if _cache_puts % _PRUNE_EVERY == 0:
+                _prune_cache(conn)
+    except sqlite3.Error:
+        pass
+
+
+# --- Logic Layer ---
+def _length_rule(max_output_tokens: int | None) -> str:
+    # Stated in the prompt so a capped answer comes back short instead of cut off
+    # (a truncated reply fails validation).
+    if not max_output_tokens:
+        return ""
+    return f"- Keep the whole JSON answer under {max_output_tokens * 3 // 5} words.\n"
+
+
+def build_prompt(role, task, context, format_instr, module_type, pages, k=6, max_chars=7000,
+                 max_output_tokens=None) -> str:
+    ctx = CONTEXT_INSTRUCTIONS.get(module_type, DEFAULT_INSTRUCTION)
+
+    pdf_ctx = retrieve_pdf_context(f"{task}\n{context}", pages, k, max_chars)
+
+    reference_block = f"\n\nTRAINING PDF REFERENCE (use as your primary source):\n{pdf_ctx}\n" if pdf_ctx else ""
+
+    return f"""Role: {role}
+
+Task: {task}
+
+Additional guidance:
+{ctx}
+
+Instructions:
+- Use the TRAINING PDF REFERENCE as your primary source.
+- Be detailed and practical.
+- When giving formulas, include exact Excel formulas and explain each part.
+- When giving steps, include exact menu clicks and what the user should see.
+- Include edge cases (blanks, not found, wrong data types) and how to handle them.
+- If the user pasted sensitive data, warn them to anonymise.
+{_length_rule(max_output_tokens)}
+User input:
+{context}
+
+{reference_block}
+
+Output format: {format_instr}
+
+Return ONLY valid JSON."""
+
+
+# --- Budgets ---
+# usage.degradation() picks the retrieval budget, output cap and cached-only
+# flag for the caller's session/cohort; any degraded level also runs only the
+# first tier of the route. `build(plan)` returns the prompt for a level, so in
+# cached-only mode an answer saved at any level can still be served.
+def _plan_route(module_type: str, plan: usage.Degradation) -> routing.Route:
+    route = routing.route_for(module_type)
+    return routing.degraded(route, plan.max_output_tokens) if plan.level else route
+
+
+def _output_cap(module_type: str, plan: usage.Degradation) -> int | None:
+    # The cap of the tier that answers first. The prompt always states it: an
+    # answer sized for it is also safe on later tiers, whose larger caps leave
+    # room for thinking tokens.
+    route = _plan_route(module_type, plan)
+    return route.tiers[0].max_output_tokens if route.tiers else None
+
+
+def _saved_answer(build, module_type: str) -> dict | None:
+    keys = dict.fromkeys(_cache_key(_plan_route(module_type, d).signature, build(d)) for d in usage.levels())
+    for key in keys:
+        cached = cache_get(key)
+        if cached is not None:
+            return cached
+    return None
+
+
+def _with_notice(result: dict, plan: usage.Degradation) -> dict:
+    return {**result, "notice": plan.notice} if plan.notice else result
+
+
+def _unavailable(plan: usage.Degradation) -> dict:
+    return {"error": f"{plan.notice or usage.QUOTA_NOTICE} {usage.NO_CACHED_ANSWER}"}
+
+
+def _answer(build, plan, format_instr, module_type, session_id, cohort) -> dict:
+    route = _plan_route(module_type, plan)
+    prompt = build(plan)
+    key = _cache_key(route.signature, prompt)
+    cached = cache_get(key)
+    if cached is None and plan.cached_only:
+        cached = _saved_answer(build, module_type)
+    if cached is not None:
+        usage.record_usage(session_id, cohort, module_type, 0, 0, plan.level, cached=True)
+        return _with_notice(cached, plan)
+    if plan.cached_only:
+        return _unavailable(plan)
+
+    result, spent = routing.run_cascade(route, prompt, format_instr)
+    usage.record_usage(session_id, cohort, module_type, *spent, plan.level)
+    if "error" in result:
+        if is_quota_error(result["error"]):
+            usage.note_quota_exhausted()
+            saved = _saved_answer(build, module_type)
+            return _with_notice(saved, plan._replace(notice=usage.QUOTA_NOTICE)) if saved else _unavailable(plan)
+        return result
+    cache_put(key, result)
+    return _with_notice(result, plan)
+
+
+def call_gemini(role, task, context, format_instr, module_type="draft", pages=(), session_id="", cohort=""):
+    missing = missing_key_error()
+    if missing:
+        return missing
+
+    def build(plan):
+        return build_prompt(role, task, context, format_instr, module_type, pages, plan.k, plan.max_chars,
+                            _output_cap(module_type, plan))
+
+    return _answer(build, usage.degradation(session_id, cohort), format_instr, module_type, session_id, cohort)
+
+
+def stream_gemini(role, task, context, format_instr, module_type="draft", pages=(), session_id="", cohort=""):
+    # Yields {"delta": text} events as the model produces output ({"escalate":
+    # model} if the cascade moves up a tier), then a final {"result": dict}.
+    missing = missing_key_error()
+    if missing:
+        yield {"result": missing}
+        return
+
+    def build(plan):
+        return build_prompt(role, task, context, format_instr, module_type, pages, plan.k, plan.max_chars,
+                            _output_cap(module_type, plan))
+
+    plan = usage.degradation(session_id, cohort)
+    if plan.cached_only:
+        yield {"result": _answer(build, plan, format_instr, module_type, session_id, cohort)}
+        return
+
+    route = _plan_route(module_type, plan)
+    prompt = build(plan)
+    key = _cache_key(route.signature, prompt)
+    cached = cache_get(key)
+    if cached is not None:
+        usage.record_usage(session_id, cohort, module_type, 0, 0, plan.level, cached=True)
+        yield {"result": _with_notice(cached, plan)}
+        return
+
+    events = routing.stream_cascade(route, prompt, format_instr)
+    spent, streamed, charged = routing.Usage(), [], False
+    try:
+        for event in events:
+            if "delta" in event:
+                streamed.append(event["delta"])
+                yield event
+                continue
+            if "escalate" in event:
+                spent, streamed = event["usage"], []
+                yield {"escalate": event["escalate"]}
+                continue
+            result = event["result"]
+            usage.record_usage(session_id, cohort, module_type, *event["usage"], plan.level)
+            charged = True
+            if "error" in result and is_quota_error(result["error"]):
+                usage.note_quota_exhausted()
+                saved = _saved_answer(build, module_type)
+                result = _with_notice(saved, plan._replace(notice=usage.QUOTA_NOTICE)) if saved else _unavailable(plan)
+            elif "error" not in result:
+                cache_put(key, result)
+                result = _with_notice(result, plan)
+            yield {"result": result}
+    finally:
+        if not charged:
+            # The client went away mid-stream. The tokens were still generated, so
+            # charge the finished tiers plus an estimate for the one cut off.
+            events.close()
+            usage.record_usage(session_id, cohort, module_type, spent.prompt_tokens + estimate_tokens(prompt),
+                               spent.output_tokens + estimate_tokens("".join(streamed)), plan.level)
+
+
+# --- Conversations ---
+# Multi-turn labs keep a plain dict per session (safe to hold in Streamlit
+# session state): a rolling summary, the most recent turns verbatim, and the
+# pages retrieved so far. Once the verbatim turns exceed HISTORY_TOKEN_BUDGET
+# the oldest exchanges are folded into the summary, and turns too long to fit
+# even then are clipped in the prompt (the UI still shows them whole), so the
+# prompt stays bounded however long the conversation runs. Retrieval only
+# looks at the new message.
+
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "1500"))
+SUMMARY_TOKEN_BUDGET = int(os.environ.get("SUMMARY_TOKEN_BUDGET", "400"))
+CONVERSATION_PAGES = 6
+SUMMARY_FORMAT = "JSON: { 'summary': string }"
+
+
+def new_conversation() -> dict:
+    return {"summary": "", "turns": [], "pages": []}
+
+
+def _turns_tokens(turns: list[dict]) -> int:
+    return sum(estimate_tokens(t["text"]) for t in turns)
+
+
+def _clip_turns(turns: list[dict], budget: int) -> list[dict]:
+    # Only over budget when the latest exchange alone is (it is never folded):
+    # short turns stay whole and the long ones share the rest, keeping their
+    # start and end.
+    if _turns_tokens(turns) <= budget:
+        return turns
+    fits = [t for t in turns if estimate_tokens(t["text"]) <= budget // len(turns)]
+    share = (budget - _turns_tokens(fits)) // (len(turns) - len(fits))
+    half = (share * 4 - len(" [...] ")) // 2
+    return [t if estimate_tokens(t["text"]) <= share else {**t, "text": f"{t['text'][:half]} [...] {t['text'][-half:]}"}
+            for t in turns]
+
+
+def _render_turns(turns: list[dict]) -> str:
+    return "\n".join(f"{t['role'].upper()}: {t['text']}" for t in _clip_turns(turns, HISTORY_TOKEN_BUDGET))
+
+
+def _fallback_summary(summary: str, turns: list[dict]) -> str:
+    # Used when the model is unavailable: keep the opening of each turn and
+    # drop the oldest text once the summary is over budget.
+    lines = [summary] if summary else []
+    lines += [f"{t['role']}: {t['text'][:200]}" for t in turns]
+    text = "\n".join(lines)
+    limit = SUMMARY_TOKEN_BUDGET * 4
+    return text[-limit:] if len(text) > limit else text
+
+
+def _summarize(summary: str, turns: list[dict], session_id: str = "", cohort: str = "") -> str:
+    # Charged to the conversation's session/cohort; no model call at all while
+    # the budget is in cached-only mode or the API quota is cooling down.
+    plan = usage.degradation(session_id, cohort)
+    if plan.cached_only:
+        return _fallback_summary(summary, turns)
+    prompt = f"""Update the running summary of an Excel tutoring conversation.
+
+Keep: the learner's goal, column names, sample data shape, formulas or steps already given, decisions and open questions.
+Drop: pleasantries and repeated explanations. Maximum {SUMMARY_TOKEN_BUDGET * 3 // 4} words.
+
+Current summary:
+{summary or "(none)"}
+
+Turns to fold in:
+{_render_turns(turns)}
+
+Output format: {SUMMARY_FORMAT}
+
+Return ONLY valid JSON."""
+    result, spent = routing.run_cascade(_plan_route("summary", plan), prompt, SUMMARY_FORMAT)
+    usage.record_usage(session_id, cohort, "summary", *spent, plan.level)
+    if "error" in result and is_quota_error(result["error"]):
+        usage.note_quota_exhausted()
+    # validate_reply only checks the field is non-empty, not that it is text.
+    if not isinstance(result.get("summary"), str):
+        return _fallback_summary(summary, turns)
+    return result["summary"].strip()
+
+
+def compact_conversation(conv: dict, session_id: str = "", cohort: str = "") -> None:
+    # Fold the oldest exchanges into the summary until the verbatim history fits.
+    # The latest exchange is always kept; prompts clip it if it alone is over budget.
+    turns = conv["turns"]
+    folded = []
+    while _turns_tokens(turns) > HISTORY_TOKEN_BUDGET and len(turns) > 2:
+        folded += turns[:2]
+        turns = turns[2:]
+    if folded:
+        conv["summary"] = _summarize(conv["summary"], folded, session_id, cohort)
+        conv["turns"] = turns
+
+
+def build_conversation_prompt(role, task, message, format_instr, module_type, conv, pdf_ctx,
+                              max_output_tokens=None) -> str:
+    ctx = CONTEXT_INSTRUCTIONS.get(module_type, DEFAULT_INSTRUCTION)
+    summary_block = f"\nConversation summary so far:\n{conv['summary']}\n" if conv["summary"] else ""
+    turns_block = f"\nRecent turns:\n{_render_turns(conv['turns'])}\n" if conv["turns"] else ""
+    reference_block = f"\n\nTRAINING PDF REFERENCE (use as your primary source):\n{pdf_ctx}\n" if pdf_ctx else ""
+
+    return f"""Role: {role}
+
+Task: {task}
+
+Additional guidance:
+{ctx}
+
+Instructions:
+- This is a follow-up in an ongoing lab conversation. Build on earlier answers instead of repeating them.
+- Use the TRAINING PDF REFERENCE as your primary source.
+- When giving formulas, include exact Excel formulas and explain each part.
+- Include edge cases (blanks, not found, wrong data types) and how to handle them.
+- If the user pasted sensitive data, warn them to anonymise.
+{_length_rule(max_output_tokens)}{summary_block}{turns_block}
+New message:
+{message}
+
+{reference_block}
+
+Output format: {format_instr}
+
+Return ONLY valid JSON."""
+
+
+def _conversation_pages(task, message, conv, pages, k) -> list[int]:
+    # Retrieve for the new message only; keep earlier pages as lower-ranked context.
+    query = message if conv["turns"] else f"{task}\n{message}"
+    fresh = rank_pages(query, pages, k)
+    picked = fresh + [i for i in conv["pages"] if i not in fresh]
+    return picked[:k]
+
+
+def converse(role, task, message, format_instr, module_type, conv, pages=(), session_id="", cohort="") -> dict:
+    # Runs one turn, updating conv in place. Returns the parsed result (or error).
+    missing = missing_key_error()
+    if missing:
+        return missing
+
+    def build(plan):
+        k = min(plan.k, CONVERSATION_PAGES)
+        pdf_ctx = format_pages(_conversation_pages(task, message, conv, pages, k), pages, plan.max_chars)
+        return build_conversation_prompt(role, task, message, format_instr, module_type, conv, pdf_ctx,
+                                         _output_cap(module_type, plan))
+
+    plan = usage.degradation(session_id, cohort)
+    picked = _conversation_pages(task, message, conv, pages, min(plan.k, CONVERSATION_PAGES))
+    result = _answer(build, plan, format_instr, module_type, session_id, cohort)
+    if "error" in result:
+        return result
+
+    reply = result.get("reply") if isinstance(result.get("reply"), str) else json.dumps(result)
+    conv["turns"] += [{"role": "user", "text": message}, {"role": "assistant", "text": reply}]
+    conv["pages"] = picked
+    compact_conversation(conv, session_id, cohort)
+    return result
+
+
+# =============================================================================
+# PDF-DRIVEN CONTENT
+# =============================================================================
+
+def build_content_from_pdf(pages) -> dict:
+    def _pages_excerpt(start_page: int, end_page: int) -> str:
+        return pages_excerpt(pages, start_page, end_page)
+
+    return {
+        "Foundations": {
+            "module_title": "Part 1: Foundations",
+            "module_desc": "Understand the real cost of spreadsheet work, the shift to plain-English prompting, and what AI can do inside Excel.",
+            "time": "45-60 min",
+            "sections": [
+                {
+                    "name": "1A: The Data Problem",
+                    "icon": "📉",
+                    "time": "15 min",
+                    "theory": {
+                        "title": "The Data Problem (Why This Matters)",
+                        "philosophy": _pages_excerpt(3, 6),
+                        "formula": "Describe the OUTCOME in plain English, then include: columns involved, criteria, what to return if blank/error, and where the result should go.",
+                        "verb": "Write / Build / Fix",
+                        "instruction": "Outcome first, then column details and edge cases",
+                        "constraints": "Always specify columns + blank/error handling",
+                        "prompts": [
+                            "I spend hours each week cleaning and reporting on data. Summarise where the time goes, then list the top 5 tasks AI can remove.",
+                            "I have a CSV export with mixed dates and currency. What is the fastest AI-driven workflow in Excel to import, clean, and report?"
+                        ],
+                        "benefit": "You stop wrestling Excel syntax and start describing outcomes. This cuts spreadsheet time dramatically, especially cleaning and reporting.",
+                        "tip": "If you only do one thing: always include what to do when cells are blank or don’t match, so you avoid #N/A and #DIV/0 errors."
+                    },
+                    "lab": {
+                        "role": "Excel & Data Analysis AI Coach",
+                        "task": "Use the training PDF as your main reference. Create a step-by-step plan to solve the user's Excel/data problem and include exact formulas or clicks where relevant. Be very detailed.",
+                        "placeholder": "Describe your spreadsheet task (and paste a few sample rows or column headers). What do you want Excel to do?",
+                        "format": "JSON: { 'reply': string }",
+                        "module_type": "excel_plan",
+                        "extra_controls": None
+                    }
+                },
+                {
+                    "name": "1B: What AI Can Do in Excel",
+                    "icon": "🤖",
+                    "time": "15 min",
+                    "theory": {
+                        "title": "What AI Can Do With Your Data",
+                        "philosophy": _pages_excerpt(7, 7),
+                        "formula": "Tell AI: (1) goal, (2) your columns, (3) constraints, (4) edge cases, (5) desired output format.",
+                        "verb": "Analyse / Recommend",
+                        "instruction": "Give AI the columns and the business question",
+                        "constraints": "No vague asks, provide schema and goal",
+                        "prompts": [
+                            "Here are my columns: Date, Client, Service, Amount, Salesperson. What analyses and pivot tables should I build to find the biggest drivers of revenue?",
+                            "I need a weekly report. Suggest a reusable Excel template with formulas, conditional formatting, and a top summary box."
+                        ],
+                        "benefit": "AI becomes your on-demand Excel expert: formulas, cleaning, analysis, charts, and explaining what things mean.",
+                        "tip": "When asking for analysis, specify the exact outputs you want: trends, anomalies, top 3 insights, and one recommendation."
+                    },
+                    "lab": {
+                        "role": "Excel Copilot-Style Analyst",
+                        "task": "Using the PDF, generate a detailed analysis plan: what to calculate, which pivot tables to build, and which charts to use. Include exact steps and example formulas.",
+                        "placeholder": "Paste your column headers and tell me what question you want answered (e.g., best month, best product, anomalies).",
+                        "format": "JSON: { 'reply': string }",
+                        "module_type": "analysis",
+                        "extra_controls": None
+                    }
+                },
+                {
+                    "name": "1C: Good Prompts vs Bad Prompts",
+                    "icon": "🧠",
+                    "time": "15 min",
+                    "theory": {
+                        "title": "Prompting Rules That Make AI Accurate",
+                        "philosophy": _pages_excerpt(40, 45),
+                        "formula": "Use this structure: Goal → Columns → Criteria → Error/blank handling → Output cell/format → Example row.",
+                        "verb": "Rewrite / Improve",
+                        "instruction": "Turn vague prompts into precise prompts",
+                        "constraints": "Must mention columns + criteria + edge cases",
+                        "prompts": [
+                            "Rewrite my prompt to be specific: 'write me a formula to calculate commission'",
+                            "Rewrite my prompt: 'analyse my data' so it asks for (1) best performer, (2) unusual drops, (3) one action to take."
+                        ],
+                        "benefit": "Better prompts give better formulas and fewer errors, so you spend less time debugging and redoing work.",
+                        "tip": "If AI gives you a formula, test it on 2-3 rows manually before filling down the whole sheet."
+                    },
+                    "lab": {
+                        "role": "Prompt Engineer for Excel Tasks",
+                        "task": "Take the user's rough prompt and rewrite it into a perfect Excel AI prompt using the PDF rules. Then provide the formula or steps that prompt would produce.",
+                        "placeholder": "Paste the rough prompt you would normally type (and optionally your columns).",
+                        "format": "JSON: { 'reply': string }",
+                        "module_type": "prompt_improve",
+                        "extra_controls": None
+                    }
+                }
+            ]
+        },
+        "Formulas": {
+            "module_title": "Part 2: Formulas & Functions",
+            "module_desc": "Write formulas in plain English, cover the 12 most common formula types, and fix errors fast.",
+            "time": "45-60 min",
+            "sections": [
+                {
+                    "name": "2A: The Formula Request Formula",
+                    "icon": "🧾",
+                    "time": "15 min",
+                    "theory": {
+                        "title": "The Formula Request Formula",
+                        "philosophy": _pages_excerpt(9, 10),
+                        "formula": _pages_excerpt(9, 9),
+                        "verb": "Write",
+                        "instruction": "Describe outcome + your columns + where the result goes",
+                        "constraints": "Include blank/error output rules",
+                        "prompts": [
+                            "Write an Excel formula to calculate total revenue. Column A = guests, column B = price per person. If A is blank, show 0.",
+                            "Write a formula to flag rows where Status = Pending and Booking Date is older than 90 days. Return \"Chase\" else blank."
+                        ],
+                        "benefit": "You get correct formulas without memorising syntax. You also build a reusable prompt library.",
+                        "tip": "Ask for both: the formula AND a short explanation of how it works, so you can troubleshoot later."
+                    },
+                    "lab": {
+                        "role": "Excel Formula Writer",
+                        "task": "Write the exact Excel formula the user needs. Include robust error handling (IF, IFERROR) and explain it step-by-step. Be very detailed.",
+                        "placeholder": "Describe your goal and your columns (A, B, etc). Say what to do if blank or no match.",
+                        "format": "JSON: { 'reply': string }",
+                        "module_type": "formula_write",
+                        "extra_controls": None
+                    }
+                },
+                {
+                    "name": "2B: Real-World Formula Patterns",
+                    "icon": "🧩",
+                    "time": "15 min",
+                    "theory": {
+                        "title": "12 Formula Types + Examples",
+                        "philosophy": _pages_excerpt(10, 11),
+                        "formula": "Pick the pattern (lookup, IF/IFS, SUMIF, COUNTIF, XLOOKUP, INDEX/MATCH) then specify columns, criteria, and return value.",
+                        "verb": "Calculate",
+                        "instruction": "Choose pattern then fill in your schema",
+                        "constraints": "Return value and criteria must be explicit",
+                        "prompts": [
+                            "XLOOKUP: Find booking ref in column A, return guest name in column F. If not found, show Not Found.",
+                            "SUMIF: Sum Amount in column D where Property in column B is \'Loch View\' and Month in column C is \'July\'."
+                        ],
+                        "benefit": "Once you recognise the pattern, AI can generate it instantly for any dataset.",
+                        "tip": "If a lookup fails, check data types (text vs number) and extra spaces first. That causes most #N/A."
+                    },
+                    "lab": {
+                        "role": "Excel Pattern Coach",
+                        "task": "Identify which formula pattern fits the user's goal, then produce the best formula (or combo) with error handling and a worked example.",
+                        "placeholder": "Explain what you’re trying to calculate and paste a sample row (or column descriptions).",
+                        "format": "JSON: { 'reply': string }",
+                        "module_type": "formula_pattern",
+                        "extra_controls": None
+                    }
+                },
+                {
+                    "name": "2C: Fixing Errors & Advanced Functions",
+                    "icon": "🛠️",
+                    "time": "15 min",
+                    "theory": {
+                        "title": "Fix Errors Fast + Use Advanced Functions",
+                        "philosophy": _pages_excerpt(12, 15),
+                        "formula": "Paste the broken formula + say what it should do + describe the columns and the error. Ask AI to fix it and add IFERROR/IF guards.",
+                        "verb": "Fix",
+                        "instruction": "Error code + expected outcome + data schema",
+                        "constraints": "Must propose a corrected formula AND why the error happened",
+                        "prompts": [
+                            "This formula returns #N/A: =VLOOKUP(A2,Sheet2!A:C,3,FALSE). Column A has booking refs. Fix it and add IFERROR to show blank if not found.",
+                            "Explain what this formula does and rewrite it using XLOOKUP: =INDEX(F:F,MATCH(H2,A:A,0))"
+                        ],
+                        "benefit": "No more Googling #REF or #VALUE. You paste the problem and get the fix plus a safer version.",
+                        "tip": "Ask AI to also suggest a quick data check (TRIM, VALUE, CLEAN) when fixing #N/A or #VALUE."
+                    },
+                    "lab": {
+                        "role": "Excel Debugger",
+                        "task": "Diagnose the user’s Excel formula error, explain the root cause, then provide a corrected, safer formula with edge cases handled. Be very detailed.",
+                        "placeholder": "Paste your formula and the exact error (#N/A, #REF, #VALUE, etc). Also say what you expect the result to be.",
+                        "format": "JSON: { 'reply': string }",
+                        "module_type": "formula_fix",
+                        "extra_controls": None
+                    }
+                }
+            ]
+        },
+        "Cleaning": {
+            "module_title": "Part 3: Data Cleaning & Transformation",
+            "module_desc": "Fix messy imports, standardise formats, and transform columns quickly with AI-driven prompts and formulas.",
+            "time": "45-60 min",
+            "sections": [
+                {
+                    "name": "3A: Cleaning Messy Data",
+                    "icon": "🧼",
+                    "time": "15 min",
+                    "theory": {
+                        "title": "The Messy Data Problem",
+                        "philosophy": _pages_excerpt(17, 20),
+                        "formula": "Describe the mess (spaces, case, currency symbols, date formats) and ask for formulas and steps to standardise into a clean version column.",
+                        "verb": "Clean",
+                        "instruction": "Name the exact problems and desired final format",
+                        "constraints": "Must include target format and where output goes",
+                        "prompts": [
+                            "Clean column A names: remove extra spaces and convert to Proper Case.",
+                            "Convert currency text like '\u00a31,250' into numbers. Keep negatives and blanks safe."
+                        ],
+                        "benefit": "Cleaning is where most spreadsheet time is lost. AI helps you standardise fast so analysis actually works.",
+                        "tip": "Always keep the original column and create a new cleaned column, so you can compare before vs after."
+                    },
+                    "lab": {
+                        "role": "Excel Data Cleaning Specialist",
+                        "task": "Create a detailed cleaning plan for the user's dataset. Provide exact formulas (TRIM, CLEAN, PROPER, SUBSTITUTE, VALUE, DATEVALUE) and step-by-step instructions.",
+                        "placeholder": "Paste a few messy rows and describe what’s wrong (spaces, dates, currency, duplicates).",
+                        "format": "JSON: { 'reply': string }",
+                        "module_type": "cleaning",
+                        "extra_controls": None
+                    }
+                },
+                {
+                    "name": "3B: Transforming Columns",
+                    "icon": "🔀",
+                    "time": "15 min",
+                    "theory": {
+                        "title": "Split, Combine, Extract",
+                        "philosophy": _pages_excerpt(21, 21),
+                        "formula": "Tell AI whether you want to split, combine, or extract. Provide the pattern (space, comma, postcode format) and sample values.",
+                        "verb": "Split / Combine",
+                        "instruction": "Provide sample values and the delimiter/pattern",
+                        "constraints": "Must handle messy edge cases",
+                        "prompts": [
+                            "Split full name into First Name and Last Name (names may have middle initials).",
+                            "Split UK address into Street, Town, Postcode. Postcode format is like IV1 1AA."
+                        ],
+                        "benefit": "You stop doing manual text-to-columns and get repeatable transformations you can reuse.",
+                        "tip": "If using Text to Columns, ask AI whether Power Query is better when you need to repeat the task weekly."
+                    },
+                    "lab": {
+                        "role": "Excel Transformation Coach",
+                        "task": "Design a transformation for the user: either formulas, Text to Columns, Flash Fill, or Power Query. Provide the best method and detailed steps.",
+                        "placeholder": "Tell me what you want to split/combine/extract and paste 5 example cells.",
+                        "format": "JSON: { 'reply': string }",
+                        "module_type": "transform",
+                        "extra_controls": None
+                    }
+                },
+                {
+                    "name": "3C: Duplicates, Validation, Standards",
+                    "icon": "✅",
+                    "time": "15 min",
+                    "theory": {
+                        "title": "Standardise and Validate",
+                        "philosophy": _pages_excerpt(18, 18) + "\n\n" + _pages_excerpt(44, 45),
+                        "formula": "Ask AI for: dedupe rules, validation checks, and a reusable cleaning checklist you can apply every import.",
+                        "verb": "Validate",
+                        "instruction": "Define what counts as a duplicate and the expected format",
+                        "constraints": "Must propose checks before analysis",
+                        "prompts": [
+                            "Find duplicate rows where Email matches, keep the most recent Date, delete the rest. Give steps or formulas.",
+                            "Flag invalid postcodes in column D and highlight them with conditional formatting."
+                        ],
+                        "benefit": "A standard cleaning checklist reduces hidden errors that ruin reports and decisions.",
+                        "tip": "Build a 'cleaning library' prompt list you reuse for every import: names, dates, currency, duplicates, and blanks."
+                    },
+                    "lab": {
+                        "role": "Data Quality Auditor",
+                        "task": "Create a detailed data quality checklist for the user’s dataset and provide Excel steps to implement it (conditional formatting, validation, helper columns).",
+                        "placeholder": "Describe your dataset and what 'clean' should look like. Mention key columns (email, dates, amounts, IDs).",
+                        "format": "JSON: { 'reply': string }",
+                        "module_type": "validate",
+                        "extra_controls": None
+                    }
+                }
+            ]
+        },
+        "Advanced": {
+            "module_title": "Part 4: Analysis, Visualisation & Automation",
+            "module_desc": "Turn numbers into insights, build charts and pivots, use Copilot, and automate repetitive workflows with Power Query.",
+            "time": "45-60 min",
+            "sections": [
+                {
+                    "name": "4A: Insights & Pivot Tables",
+                    "icon": "📊",
+                    "time": "15 min",
+                    "theory": {
+                        "title": "Turning Numbers into Insights",
+                        "philosophy": _pages_excerpt(24, 25),
+                        "formula": "Ask AI: top 3 insights, best/worst performers, anomalies, and one recommendation. Then ask for a pivot table spec.",
+                        "verb": "Analyse",
+                        "instruction": "Specify the questions and desired outputs",
+                        "constraints": "Must include at least 1 action recommendation",
+                        "prompts": [
+                            "Identify trends and anomalies in this dataset, then tell me one action I should take.",
+                            "Create a pivot table: total Amount by Salesperson for each month. Explain exact steps."
+                        ],
+                        "benefit": "You get analysis that is faster and more structured, with clear pivots and interpretations.",
+                        "tip": "If you paste pivot results into AI, ask it to interpret what changed month-to-month and why."
+                    },
+                    "lab": {
+                        "role": "Excel Analyst",
+                        "task": "Give a detailed analysis workflow: metrics to compute, pivot tables to build, and how to interpret the results. Include step-by-step Excel instructions.",
+                        "placeholder": "Paste a small table (or pivot output) and tell me the business question you want answered.",
+                        "format": "JSON: { 'reply': string }",
+                        "module_type": "insights",
+                        "extra_controls": None
+                    }
+                },
+                {
+                    "name": "4B: Charts & Visualisation",
+                    "icon": "📈",
+                    "time": "15 min",
+                    "theory": {
+                        "title": "Charts That Tell the Story",
+                        "philosophy": _pages_excerpt(26, 29),
+                        "formula": "Ask: which chart type fits my question, how to set it up, and how to label it so the insight is obvious.",
+                        "verb": "Visualise",
+                        "instruction": "Choose chart type based on question (trend, compare, composition)",
+                        "constraints": "Must recommend chart + setup steps",
+                        "prompts": [
+                            "I have monthly revenue for 12 months. Which chart should I use and how should I format it to show the trend clearly?",
+                            "I want to compare sales by property. Which bar chart is best and how do I build it?"
+                        ],
+                        "benefit": "You get faster charts that communicate insights, not just visuals.",
+                        "tip": "Ask AI to also suggest 1 sentence you can put above the chart as the key takeaway."
+                    },
+                    "lab": {
+                        "role": "Data Visualisation Coach",
+                        "task": "Recommend the best chart type for the user's data and give exact Excel steps to build it. Include formatting tips and what insight it should highlight.",
+                        "placeholder": "Describe your data and what you want to show (trend, comparison, share, distribution).",
+                        "format": "JSON: { 'reply': string }",
+                        "module_type": "charts",
+                        "extra_controls": None
+                    }
+                },
+                {
+                    "name": "4C: Copilot & Automation",
+                    "icon": "⚙️",
+                    "time": "15 min",
+                    "theory": {
+                        "title": "Copilot, Power Query, and Repeatable Workflows",
+                        "philosophy": _pages_excerpt(31, 37) + "\n\n" + _pages_excerpt(48, 50),
+                        "formula": "If the task repeats monthly: ask AI for a template + Power Query steps + a prompt library to reuse.",
+                        "verb": "Automate",
+                        "instruction": "Describe the recurring workflow and ask for a reusable template + automation steps",
+                        "constraints": "Must include verification steps and data privacy guidance",
+                        "prompts": [
+                            "Walk me through setting up Power Query to import and clean my weekly CSV automatically.",
+                            "Help me build a reusable report template with formulas, conditional formatting, charts, and a top summary box."
+                        ],
+                        "benefit": "You build a system: import → clean → analyse → chart → summary, then refresh it in minutes.",
+                        "tip": "Do not paste sensitive personal data into public AI tools. Anonymise first, or use Copilot inside Excel if available."
+                    },
+                    "lab": {
+                        "role": "Excel Automation Specialist",
+                        "task": "Design an end-to-end automated workflow for the user: import, clean, analyse, chart, and summarise. Include Power Query steps where relevant. Be very detailed.",
+                        "placeholder": "Describe the recurring report you make (where the data comes from, how often, and what outputs you need).",
+                        "format": "JSON: { 'reply': string }",
+                        "module_type": "automation",
+                        "extra_controls": None
+                    }
+                }
+            ]
+        }
+    }
+
+
+def get_section(content: dict, view: str, index: int) -> dict | None:
+    mod = content.get(view)
+    if mod is None or not 0 <= index < len(mod["sections"]):
+        return None
+    return mod["sections"][index]
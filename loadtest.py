@@ -0,0 +1,331 @@
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import queue
+import random
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from streamlit.testing.v1 import AppTest
+
+import labs
+import models
+import routing
+import usage
+
+# =============================================================================
+# CONCURRENT-SESSION LOAD TEST
+# =============================================================================
+# Drives N simulated learners through app.py with Streamlit's headless AppTest.
+# Sessions run in separate processes pinned to one CPU budget (--cpus), which
+# stands in for one server replica. Gemini is replaced by the local stub model
+# (configurable latency and error rate).
+#
+#   python loadtest.py --levels 1,2,4,8,16 --iterations 3 --latency 0.5 --error-rate 0.05
+#
+# Each journey: open app -> pick a module in the sidebar -> pick a section ->
+# "Launch Interactive Lab" -> type context -> "Run Lab Test" -> "Back to Theory".
+#
+# Labs run on the first tier of each route only, so a failed stub call is a
+# failed lab and --error-rate is the error rate learners see (--cascade keeps
+# the full cascade, which retries failures on the next tier). Attempt-level
+# failures are reported from the routing metrics either way.
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+# Upper bound for every worker to warm up and reach the start barrier.
+WARMUP_TIMEOUT = 300
+MODULE_LABELS = [
+    "1️⃣ Part 1: Foundations",
+    "2️⃣ Part 2: Formulas & Functions",
+    "3️⃣ Part 3: Data Cleaning",
+    "4️⃣ Part 4: Analysis, Charts & Automation",
+]
+
+
+class SessionStats:
+    def __init__(self):
+        self.latencies = {}   # step name -> [seconds]
+        self.reruns = 0
+        self.script_errors = 0
+        self.lab_errors = 0
+
+    def record(self, step: str, seconds: float) -> None:
+        self.latencies.setdefault(step, []).append(seconds)
+        self.reruns += 1
+
+
+def _button(at: AppTest, label: str):
+    for b in at.button:
+        if b.label == label:
+            return b
+    raise LookupError(f"Button {label!r} not rendered")
+
+
+def _timed(stats: SessionStats, step: str, action) -> AppTest:
+    start = time.perf_counter()
+    at = action()
+    stats.record(step, time.perf_counter() - start)
+    if at.exception:
+        stats.script_errors += 1
+    return at
+
+
+def run_session(session_id: int, iterations: int, think: float, rng: random.Random, stats: SessionStats) -> AppTest:
+    at = AppTest.from_file(APP_PATH, default_timeout=300)
+    _timed(stats, "open", at.run)
+    for n in range(iterations):
+        _timed(stats, "sidebar", lambda: at.sidebar.radio[0].set_value(rng.choice(MODULE_LABELS)).run())
+        time.sleep(think)
+        _timed(stats, "section", lambda: at.button(key=f"sec_{rng.randrange(3)}").click().run())
+        time.sleep(think)
+        _timed(stats, "launch_lab", lambda: _button(at, "Launch Interactive Lab").click().run())
+        time.sleep(think)
+        text = f"Session {session_id} run {n}: columns Date, Client, Amount. Sum Amount per Client and flag blanks."
+        _timed(stats, "type_context", lambda: at.text_area[0].input(text).run())
+        time.sleep(think)
+        _timed(stats, "run_lab", lambda: _button(at, "Run Lab Test").click().run())
+        result = at.session_state["last_result"] if "last_result" in at.session_state else {}
+        if "error" in result:
+            stats.lab_errors += 1
+        time.sleep(think)
+        _timed(stats, "back_to_theory", lambda: _button(at, "Back to Theory").click().run())
+    return at
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[idx]
+
+
+def _session_worker(session_id, iterations, think, seed, cpus, barrier, results):
+    # Always reports exactly one result, so the parent never waits on a dead worker.
+    stats = SessionStats()
+    failure = None
+    try:
+        if cpus and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+        # Warm the per-process shared caches (corpus store, content) the way a
+        # long-running server would have them before learners arrive.
+        AppTest.from_file(APP_PATH, default_timeout=300).run()
+    except Exception as e:
+        failure = f"session {session_id} warm-up: {e}"
+    try:
+        barrier.wait(WARMUP_TIMEOUT)
+    except threading.BrokenBarrierError:
+        failure = failure or f"session {session_id}: start barrier broken"
+    if failure is None:
+        try:
+            run_session(session_id, iterations, think, random.Random(seed + session_id), stats)
+        except Exception as e:
+            failure = f"session {session_id}: {e}"
+    results.put((stats.__dict__, failure))
+
+
+def run_level(concurrency: int, iterations: int, think: float, seed: int, cpus: set[int] | None,
+              timeout: float) -> dict:
+    # AppTest swaps a process-global Runtime in and out around every rerun, so
+    # concurrent sessions need their own processes. Pinning them all to the same
+    # CPU set keeps the contention of a single replica.
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(concurrency + 1)
+    results = ctx.Queue()
+    procs = [
+        ctx.Process(target=_session_worker, args=(i, iterations, think, seed, cpus, barrier, results))
+        for i in range(concurrency)
+    ]
+    for p in procs:
+        p.start()
+    try:
+        barrier.wait(WARMUP_TIMEOUT)
+    except threading.BrokenBarrierError:
+        pass   # a worker died or stalled in warm-up; the others report the broken barrier
+    start = time.perf_counter()
+    deadline = time.monotonic() + timeout
+    collected = []
+    for _ in procs:
+        try:
+            collected.append(results.get(timeout=max(0.1, deadline - time.monotonic())))
+        except queue.Empty:
+            break
+    wall = time.perf_counter() - start
+    for p in procs:
+        p.join(5)
+        if p.is_alive():
+            p.terminate()
+            p.join()
+
+    stats = []
+    failures = []
+    if len(collected) < len(procs):
+        failures.append(f"{len(procs) - len(collected)} session(s) did not report within {timeout:.0f}s")
+    for state, failure in collected:
+        s = SessionStats()
+        s.__dict__.update(state)
+        stats.append(s)
+        if failure:
+            failures.append(failure)
+
+    all_latencies = [x for s in stats for v in s.latencies.values() for x in v]
+    per_step = {}
+    for s in stats:
+        for step, values in s.latencies.items():
+            per_step.setdefault(step, []).extend(values)
+    reruns = sum(s.reruns for s in stats)
+    return {
+        "concurrency": concurrency,
+        "wall_s": wall,
+        "reruns": reruns,
+        "throughput_rps": reruns / wall if wall else 0.0,
+        "p50_s": _percentile(all_latencies, 50),
+        "p95_s": _percentile(all_latencies, 95),
+        "p99_s": _percentile(all_latencies, 99),
+        "mean_s": statistics.fmean(all_latencies) if all_latencies else 0.0,
+        "steps": {step: {"p50_s": _percentile(v, 50), "p95_s": _percentile(v, 95)} for step, v in per_step.items()},
+        "script_errors": sum(s.script_errors for s in stats),
+        "lab_errors": sum(s.lab_errors for s in stats),
+        "session_failures": failures,
+    }
+
+
+def _session_state_bytes(at: AppTest) -> int:
+    # What a real server keeps per learner: the pickled session state.
+    total = 0
+    for key in at.session_state:
+        try:
+            total += len(pickle.dumps(at.session_state[key]))
+        except Exception:
+            pass   # widget internals that a server would not pickle either
+    return total
+
+
+def measure_session_memory(sessions: int, seed: int) -> dict:
+    # Bytes per live session after one full journey: the session state itself,
+    # and the Python heap retained by the whole AppTest session, which is mostly
+    # AppTest's own element tree (an upper bound, not what a server holds).
+    # Run separately from the latency sweep because tracing slows everything down.
+    AppTest.from_file(APP_PATH, default_timeout=300).run()   # warm shared caches first
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    alive = [run_session(i, 1, 0.0, random.Random(seed + i), SessionStats()) for i in range(sessions)]
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    state = sum(_session_state_bytes(at) for at in alive)
+    del alive
+    return {"session_state_bytes": state / sessions, "apptest_heap_bytes": used / sessions}
+
+
+def single_tier_routes(path: str) -> None:
+    # Writes a copy of model_routes.json that keeps only the first tier of every route.
+    config = routing.load_routes()
+    first = {name: {"cascade": spec["cascade"][:1]} for name, spec in config.get("routes", {}).items()}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"default": {"cascade": config["default"]["cascade"][:1]}, "routes": first}, f, indent=2)
+
+
+def attempt_stats(since: float) -> tuple[int, int]:
+    # Model calls made by the sessions (every tier tried) and how many failed.
+    rows = routing.metrics_summary(since, backend="stub")
+    return sum(r["attempts"] for r in rows), sum(r["failed"] for r in rows)
+
+
+def find_saturation(levels: list[dict], slo_s: float, min_gain: float) -> int | None:
+    # First level where adding sessions stops buying throughput, or p95 breaks the SLO.
+    prev = None
+    for level in levels:
+        if level["p95_s"] > slo_s:
+            return level["concurrency"]
+        if prev and level["throughput_rps"] < prev["throughput_rps"] * (1 + min_gain):
+            return level["concurrency"]
+        prev = level
+    return None
+
+
+def print_report(levels: list[dict], memory: dict | None, saturation: int | None, args) -> None:
+    routes = "full cascade" if args.cascade else "first tier only"
+    print(f"\nReplica CPUs: {args.cpus or 'all'} | stub model: latency={args.latency}s error_rate={args.error_rate} ({routes}) | iterations/session={args.iterations} think={args.think}s")
+    print(f"{'sessions':>8} {'reruns':>7} {'rps':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} "
+          f"{'calls':>6} {'failed':>6}")
+    for lv in levels:
+        errors = lv["script_errors"] + lv["lab_errors"] + len(lv["session_failures"])
+        print(f"{lv['concurrency']:>8} {lv['reruns']:>7} {lv['throughput_rps']:>7.1f} "
+              f"{lv['p50_s'] * 1000:>8.0f} {lv['p95_s'] * 1000:>8.0f} {lv['p99_s'] * 1000:>8.0f} {errors:>7} "
+              f"{lv['model_calls']:>6} {lv['model_call_failures']:>6}")
+    print("(errors: script errors, failed labs and lost sessions; calls/failed: model attempts across all tiers)")
+    if levels:
+        print("\nPer-step p95 (ms) at highest level:")
+        for step, v in levels[-1]["steps"].items():
+            print(f"  {step:<15} {v['p95_s'] * 1000:>8.0f}")
+    if memory is not None:
+        print(f"\nSession state per session: {memory['session_state_bytes'] / 1024:.1f} KiB (pickled)")
+        print(f"AppTest heap per session: {memory['apptest_heap_bytes'] / 1024:.1f} KiB "
+              "(tracemalloc, includes AppTest's own element tree)")
+    if saturation is None:
+        print(f"Saturation: not reached (p95 <= {args.slo}s and throughput still scaling)")
+    else:
+        print(f"Saturation point: {saturation} concurrent sessions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for the Streamlit app.")
+    parser.add_argument("--levels", default="1,2,4,8,16", help="Comma-separated concurrent session counts.")
+    parser.add_argument("--iterations", type=int, default=2, help="Lab journeys per session.")
+    parser.add_argument("--think", type=float, default=0.0, help="Seconds between interactions.")
+    parser.add_argument("--latency", type=float, default=0.5, help="Stub model latency in seconds.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Stub model failure probability.")
+    parser.add_argument("--slo", type=float, default=2.0, help="p95 rerun latency (s) treated as saturated.")
+    parser.add_argument("--min-gain", type=float, default=0.1, help="Throughput gain below which a level counts as saturated.")
+    parser.add_argument("--memory-sessions", type=int, default=5, help="Sessions used for the memory measurement (0 to skip).")
+    parser.add_argument("--use-cache", action="store_true", help="Keep the shared response cache (default: a throwaway one).")
+    parser.add_argument("--cascade", action="store_true", help="Use the full model cascade (default: first tier only).")
+    parser.add_argument("--cpus", default="0", help="CPU ids the replica may use, e.g. '0' or '0,1' (empty: no pinning).")
+    parser.add_argument("--timeout", type=float, default=900.0, help="Seconds to wait for a level's sessions to finish.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the full report to this path.")
+    args = parser.parse_args()
+
+    # Environment is inherited by the session processes; module globals cover
+    # the in-process memory measurement.
+    os.environ["LAB_MODEL_BACKEND"] = models.MODEL_BACKEND = "stub"
+    os.environ["STUB_LATENCY"] = str(args.latency)
+    os.environ["STUB_ERROR_RATE"] = str(args.error_rate)
+    tmp_dir = tempfile.mkdtemp(prefix="loadtest_")
+    if not args.use_cache:
+        path = os.path.join(tmp_dir, "responses.sqlite")
+        os.environ["RESPONSE_CACHE_PATH"] = labs.RESPONSE_CACHE_PATH = path
+    # Simulated sessions must not spend the real cohort token budget or mix
+    # stub latencies into the routing metrics used to tune model_routes.json.
+    os.environ["USAGE_LEDGER_PATH"] = usage.LEDGER_PATH = os.path.join(tmp_dir, "usage.sqlite")
+    os.environ["ROUTING_METRICS_PATH"] = routing.METRICS_PATH = os.path.join(tmp_dir, "routing.sqlite")
+    if not args.cascade:
+        path = os.path.join(tmp_dir, "model_routes.json")
+        single_tier_routes(path)
+        os.environ["MODEL_ROUTES_PATH"] = routing.ROUTES_PATH = path
+    cpus = {int(c) for c in args.cpus.split(",") if c.strip()} or None
+
+    levels = []
+    for concurrency in [int(x) for x in args.levels.split(",") if x.strip()]:
+        since = time.time()
+        levels.append(run_level(concurrency, args.iterations, args.think, args.seed, cpus, args.timeout))
+        levels[-1]["model_calls"], levels[-1]["model_call_failures"] = attempt_stats(since)
+        print(f"  {concurrency} sessions done in {levels[-1]['wall_s']:.1f}s", flush=True)
+
+    memory = measure_session_memory(args.memory_sessions, args.seed) if args.memory_sessions > 0 else None
+    saturation = find_saturation(levels, args.slo, args.min_gain)
+    print_report(levels, memory, saturation, args)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"levels": levels, "memory_per_session": memory, "saturation": saturation,
+                       "config": vars(args)}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import random
+import re
+import time
+from typing import NamedTuple
+
+import google.generativeai as genai
+
+# =============================================================================
+# MODEL BACKENDS
+# =============================================================================
+
+API_KEY = os.environ.get("API_KEY", "")
+if API_KEY:
+    genai.configure(api_key=API_KEY)
+
+MODEL_NAME = "gemini-2.5-flash-lite"
+# "gemini" talks to the real API; "stub" is a local fake for tests and load runs.
+MODEL_BACKEND = os.environ.get("LAB_MODEL_BACKEND", "gemini")
+
+
+class ModelReply(NamedTuple):
+    text: str
+    prompt_tokens: int
+    output_tokens: int
+    truncated: bool          # stopped at max_output_tokens
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+# --- Error Classes ---
+# Quota and credential errors fail the same way on every model, so they are
+# not worth retrying on another tier; anything else is treated as transient.
+_QUOTA_ERROR = re.compile(r"\b429\b|quota|resource.?exhausted|rate.?limit", re.IGNORECASE)
+_AUTH_ERROR = re.compile(r"\b40[13]\b|api.?key|permission.?denied|unauthenticated", re.IGNORECASE)
+
+
+def is_quota_error(message: str) -> bool:
+    return bool(_QUOTA_ERROR.search(message or ""))
+
+
+def is_retryable_error(message: str) -> bool:
+    return not (is_quota_error(message) or _AUTH_ERROR.search(message or ""))
+
+
+class GeminiModel:
+    def __init__(self, name: str = MODEL_NAME):
+        self.name = name
+        self._model = genai.GenerativeModel(name)
+
+    def _config(self, max_output_tokens: int | None):
+        return genai.types.GenerationConfig(
+            response_mime_type="application/json",
+            max_output_tokens=max_output_tokens,
+        )
+
+    @staticmethod
+    def _reply(response, text: str) -> ModelReply:
+        usage = getattr(response, "usage_metadata", None)
+        candidates = getattr(response, "candidates", None) or []
+        finish = getattr(candidates[0].finish_reason, "name", "") if candidates else ""
+        return ModelReply(
+            text,
+            getattr(usage, "prompt_token_count", 0) or 0,
+            getattr(usage, "candidates_token_count", 0) or 0,
+            finish == "MAX_TOKENS",
+        )
+
+    def generate(self, prompt: str, max_output_tokens: int | None = None) -> ModelReply:
+        response = self._model.generate_content(prompt, generation_config=self._config(max_output_tokens))
+        return self._reply(response, response.text)
+
+    def stream(self, prompt: str, max_output_tokens: int | None = None):
+        # Yields text chunks, then the ModelReply for the whole response.
+        response = self._model.generate_content(prompt, generation_config=self._config(max_output_tokens), stream=True)
+        parts = []
+        for chunk in response:
+            if chunk.text:
+                parts.append(chunk.text)
+                yield chunk.text
+        yield self._reply(response, "".join(parts))
+
+
+class StubModel:
+    # Answers locally with a canned JSON reply. Latency and failure rates are
+    # configurable so the UI, the API and load tests can run without Gemini.
+    # STUB_INVALID_RATE returns an empty reply to exercise cascade escalation.
+    def __init__(self, name: str = MODEL_NAME, latency: float | None = None, error_rate: float | None = None,
+                 invalid_rate: float | None = None):
+        self.name = name
+        self.latency = float(os.environ.get("STUB_LATENCY", "0")) if latency is None else latency
+        self.error_rate = float(os.environ.get("STUB_ERROR_RATE", "0")) if error_rate is None else error_rate
+        self.invalid_rate = float(os.environ.get("STUB_INVALID_RATE", "0")) if invalid_rate is None else invalid_rate
+
+    def _reply(self, prompt: str, max_output_tokens: int | None) -> ModelReply:
+        time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            raise RuntimeError("Stub model error (simulated)")
+        if self.invalid_rate and random.random() < self.invalid_rate:
+            text = json.dumps({"reply": ""})
+        else:
+            digest = hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8]
+            answer = f"[{self.name} stub {digest}] Prompt received ({len(prompt)} chars)."
+            # Obey a length rule in the prompt, as a real model mostly would.
+            limit = re.search(r"answer under (\d+) words", prompt)
+            if limit:
+                answer = " ".join(answer.split()[:max(1, int(limit.group(1)))])
+            # Fill whichever fields the prompt's "Output format:" line asks for.
+            fmt = prompt.rsplit("Output format:", 1)[-1] if "Output format:" in prompt else ""
+            fields = re.findall(r"['\"](\w+)['\"]\s*:", fmt) or ["reply"]
+            text = json.dumps({field: answer for field in fields})
+        truncated = False
+        if max_output_tokens and estimate_tokens(text) > max_output_tokens:
+            text, truncated = text[:max_output_tokens * 4], True
+        return ModelReply(text, estimate_tokens(prompt), estimate_tokens(text), truncated)
+
+    def generate(self, prompt: str, max_output_tokens: int | None = None) -> ModelReply:
+        return self._reply(prompt, max_output_tokens)
+
+    def stream(self, prompt: str, max_output_tokens: int | None = None):
+        reply = self._reply(prompt, max_output_tokens)
+        step = max(1, len(reply.text) // 4)
+        for i in range(0, len(reply.text), step):
+            yield reply.text[i:i + step]
+        yield reply
+
+
+def get_model(name: str = MODEL_NAME):
+    if MODEL_BACKEND == "stub":
+        return StubModel(name)
+    return GeminiModel(name)
+
+
+def missing_key_error() -> dict | None:
+    if MODEL_BACKEND == "gemini" and not API_KEY:
+        return {"error": "API Key missing. Please set your API_KEY in the environment."}
+    return None
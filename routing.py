@@ -0,0 +1,248 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import time
+from typing import NamedTuple
+
+import models
+from corpus import CACHE_DIR
+from storage import connect_sqlite, load_json_config
+
+# =============================================================================
+# MODEL ROUTING
+# =============================================================================
+# Each module_type maps to a cascade of (model, max_output_tokens) tiers in
+# model_routes.json. The first tier answers; the next one is tried only when
+# the answer fails local checks (bad JSON, missing/empty fields, truncation)
+# or the call hits a transient error. Quota and credential errors end the
+# cascade at once. Every attempt is logged, with its backend, for tuning the
+# config.
+
+ROUTES_PATH = os.environ.get(
+    "MODEL_ROUTES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_routes.json")
+)
+METRICS_PATH = os.environ.get("ROUTING_METRICS_PATH", os.path.join(CACHE_DIR, "routing.sqlite"))
+
+
+class Tier(NamedTuple):
+    model: str
+    max_output_tokens: int | None
+
+
+class Route(NamedTuple):
+    module_type: str
+    tiers: tuple[Tier, ...]
+
+    @property
+    def signature(self) -> str:
+        return "|".join(f"{t.model}:{t.max_output_tokens}" for t in self.tiers)
+
+
+class Usage(NamedTuple):
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+
+    def add(self, reply: models.ModelReply | None) -> "Usage":
+        if reply is None:
+            return self
+        return Usage(self.prompt_tokens + reply.prompt_tokens, self.output_tokens + reply.output_tokens)
+
+
+# --- Config ---
+_DEFAULT_ROUTE = {"cascade": [{"model": models.MODEL_NAME, "max_output_tokens": None}]}
+
+
+def load_routes(path: str | None = None) -> dict:
+    return load_json_config(path or ROUTES_PATH, {"default": _DEFAULT_ROUTE, "routes": {}})
+
+
+def route_for(module_type: str, path: str | None = None) -> Route:
+    config = load_routes(path)
+    spec = config.get("routes", {}).get(module_type) or config.get("default") or _DEFAULT_ROUTE
+    tiers = tuple(Tier(t["model"], t.get("max_output_tokens")) for t in spec["cascade"])
+    return Route(module_type, tiers)
+
+
+def degraded(route: Route, max_output_tokens: int | None = None) -> Route:
+    # Used when a usage budget runs low: first tier only, so nothing escalates
+    # to a pricier model, optionally with a tighter output cap.
+    tiers = route.tiers[:1]
+    if max_output_tokens:
+        tiers = tuple(t._replace(max_output_tokens=min(t.max_output_tokens or max_output_tokens, max_output_tokens))
+                      for t in tiers)
+    return route._replace(tiers=tiers)
+
+
+# --- Local Checks ---
+def expected_fields(format_instr: str) -> dict[str, str]:
+    # "JSON: { 'reply': string, 'urgency': string }" -> {"reply": "string", ...}
+    return dict(re.findall(r"['\"](\w+)['\"]\s*:\s*(\w+)", format_instr or ""))
+
+
+def validate_reply(reply: models.ModelReply, format_instr: str) -> tuple[dict | None, str]:
+    if reply.truncated:
+        return None, "truncated"
+    try:
+        result = json.loads(reply.text)
+    except (TypeError, ValueError):
+        return None, "invalid_json"
+    if not isinstance(result, dict):
+        return None, "not_object"
+    for field, kind in expected_fields(format_instr).items():
+        if field not in result:
+            return None, f"missing:{field}"
+        if kind == "string" and not str(result[field] or "").strip():
+            return None, f"empty:{field}"
+    return result, "ok"
+
+
+# --- Metrics ---
+def _add_backend_column(conn: sqlite3.Connection) -> None:
+    # Stores created before the backend column: their rows count as gemini.
+    if "backend" not in {row[1] for row in conn.execute("PRAGMA table_info(attempts)")}:
+        conn.execute("ALTER TABLE attempts ADD COLUMN backend TEXT NOT NULL DEFAULT 'gemini'")
+
+
+def _metrics_connect() -> sqlite3.Connection:
+    return connect_sqlite(METRICS_PATH, """CREATE TABLE IF NOT EXISTS attempts (
+        ts REAL NOT NULL, module_type TEXT NOT NULL, model TEXT NOT NULL, tier INTEGER NOT NULL,
+        max_output_tokens INTEGER, latency_ms REAL NOT NULL, prompt_tokens INTEGER NOT NULL,
+        output_tokens INTEGER NOT NULL, outcome TEXT NOT NULL, backend TEXT NOT NULL DEFAULT 'gemini')""",
+                          setup=_add_backend_column)
+
+
+def record_attempt(route: Route, tier: int, latency_s: float, reply: models.ModelReply | None, outcome: str) -> None:
+    t = route.tiers[tier]
+    try:
+        with _metrics_connect() as conn:
+            conn.execute(
+                "INSERT INTO attempts (ts, module_type, model, tier, max_output_tokens, latency_ms, prompt_tokens, "
+                "output_tokens, outcome, backend) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), route.module_type, t.model, tier, t.max_output_tokens, latency_s * 1000,
+                 reply.prompt_tokens if reply else 0, reply.output_tokens if reply else 0, outcome,
+                 models.MODEL_BACKEND),
+            )
+    except sqlite3.Error:
+        pass
+
+
+def metrics_summary(since: float = 0.0, backend: str = "gemini") -> list[dict]:
+    with _metrics_connect() as conn:
+        rows = conn.execute(
+            "SELECT module_type, model, tier, latency_ms, prompt_tokens, output_tokens, outcome "
+            "FROM attempts WHERE ts >= ? AND backend = ? ORDER BY module_type, tier",
+            (since, backend),
+        ).fetchall()
+    groups: dict[tuple, list] = {}
+    for row in rows:
+        groups.setdefault(row[:3], []).append(row[3:])
+    summary = []
+    for (module_type, model, tier), items in groups.items():
+        latencies = sorted(i[0] for i in items)
+        summary.append({
+            "module_type": module_type,
+            "model": model,
+            "tier": tier,
+            "attempts": len(items),
+            "p50_ms": latencies[len(latencies) // 2],
+            "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            "avg_prompt_tokens": sum(i[1] for i in items) / len(items),
+            "avg_output_tokens": sum(i[2] for i in items) / len(items),
+            "failed": sum(1 for i in items if i[3] != "ok"),
+        })
+    return summary
+
+
+# --- Cascade ---
+def _retry_truncated(route: Route, tier: int) -> bool:
+    # A cut-off answer only comes back whole from a tier with more room.
+    cap = route.tiers[tier].max_output_tokens
+    return cap is not None and any(t.max_output_tokens is None or t.max_output_tokens > cap
+                                   for t in route.tiers[tier + 1:])
+
+
+def run_cascade(route: Route, prompt: str, format_instr: str) -> tuple[dict, Usage]:
+    # Returns the result and the tokens spent across every tier tried.
+    result = {"error": "No model configured for this route."}
+    spent = Usage()
+    for tier, t in enumerate(route.tiers):
+        start = time.perf_counter()
+        try:
+            reply = models.get_model(t.model).generate(prompt, t.max_output_tokens)
+        except Exception as e:
+            record_attempt(route, tier, time.perf_counter() - start, None, "error")
+            result = {"error": str(e)}
+            if not models.is_retryable_error(str(e)):
+                break
+            continue
+        spent = spent.add(reply)
+        parsed, outcome = validate_reply(reply, format_instr)
+        record_attempt(route, tier, time.perf_counter() - start, reply, outcome)
+        if parsed is not None:
+            return parsed, spent
+        result = {"error": f"Model response failed validation ({outcome})."}
+        if outcome == "truncated" and not _retry_truncated(route, tier):
+            break
+    return result, spent
+
+
+def stream_cascade(route: Route, prompt: str, format_instr: str):
+    # Same as run_cascade, but yields {"delta": text} while a tier streams,
+    # {"escalate": model, "usage": Usage} before retrying on the next tier (usage
+    # so far, for callers that stop early), and a final {"result": dict, "usage": Usage}.
+    result = {"error": "No model configured for this route."}
+    spent = Usage()
+    for tier, t in enumerate(route.tiers):
+        if tier:
+            yield {"escalate": t.model, "usage": spent}
+        start = time.perf_counter()
+        reply = None
+        try:
+            for item in models.get_model(t.model).stream(prompt, t.max_output_tokens):
+                if isinstance(item, models.ModelReply):
+                    reply = item
+                else:
+                    yield {"delta": item}
+        except GeneratorExit:
+            record_attempt(route, tier, time.perf_counter() - start, None, "aborted")
+            raise
+        except Exception as e:
+            record_attempt(route, tier, time.perf_counter() - start, None, "error")
+            result = {"error": str(e)}
+            if not models.is_retryable_error(str(e)):
+                break
+            continue
+        spent = spent.add(reply)
+        parsed, outcome = validate_reply(reply, format_instr)
+        record_attempt(route, tier, time.perf_counter() - start, reply, outcome)
+        if parsed is not None:
+            yield {"result": parsed, "usage": spent}
+            return
+        result = {"error": f"Model response failed validation ({outcome})."}
+        if outcome == "truncated" and not _retry_truncated(route, tier):
+            break
+    yield {"result": result, "usage": spent}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-route latency, token and escalation metrics.")
+    parser.add_argument("--hours", type=float, default=24.0, help="Look-back window.")
+    parser.add_argument("--backend", default="gemini", help="Only attempts made with this backend (gemini or stub).")
+    args = parser.parse_args()
+
+    rows = metrics_summary(time.time() - args.hours * 3600, args.backend)
+    print(f"{'module_type':<16} {'tier':>4} {'model':<24} {'n':>5} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'in tok':>7} {'out tok':>7} {'failed':>6}")
+    for r in rows:
+        print(f"{r['module_type']:<16} {r['tier']:>4} {r['model']:<24} {r['attempts']:>5} {r['p50_ms']:>8.0f} "
+              f"{r['p95_ms']:>8.0f} {r['avg_prompt_tokens']:>7.0f} {r['avg_output_tokens']:>7.0f} {r['failed']:>6}")
+    # Escalation rate: share of first-tier attempts that did not settle the request.
+    for r in rows:
+        if r["tier"] == 0 and r["attempts"]:
+            print(f"{r['module_type']}: escalation rate {r['failed'] / r['attempts']:.0%}")
+
+
+if __name__ == "__main__":
+    main()
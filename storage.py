@@ -0,0 +1,71 @@
+import json
+import os
+import sqlite3
+import threading
+
+# =============================================================================
+# LOCAL STORAGE
+# =============================================================================
+# Helpers for the small local state the labs keep: JSON config files that are
+# re-read when they change on disk, and SQLite stores (WAL mode) that every UI
+# and API process on a host shares.
+
+_config_cache: dict = {}
+
+
+def load_json_config(path: str, default: dict) -> dict:
+    # Re-read when the file changes so settings can be tuned without a restart.
+    # Keys missing from the file fall back to `default`.
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return default
+    cached = _config_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, encoding="utf-8") as f:
+            cached = _config_cache[path] = (mtime, {**default, **json.load(f)})
+    return cached[1]
+
+
+def private_dir(path: str) -> str:
+    # Cached answers are rendered as HTML and the corpus store is trusted as-is,
+    # so only this user may write them: create the directory 0700 and refuse one
+    # that another user owns or can write to.
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.stat(path)
+    if hasattr(os, "getuid") and (st.st_uid != os.getuid() or st.st_mode & 0o022):
+        raise PermissionError(f"{path} must be owned by the current user and not writable by others")
+    return path
+
+
+_sqlite_local = threading.local()
+_sqlite_ready: set[str] = set()
+_sqlite_ready_lock = threading.Lock()
+
+
+def connect_sqlite(path: str, *schema: str, setup=None) -> sqlite3.Connection:
+    # One connection per thread and store, reused across calls (`with conn:`
+    # still commits or rolls back each use). The WAL switch, `schema` (idempotent
+    # CREATE ... IF NOT EXISTS statements) and `setup(conn)` (migrations,
+    # housekeeping) run once per process.
+    conns = getattr(_sqlite_local, "conns", None)
+    if conns is None:
+        conns = _sqlite_local.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        try:
+            private_dir(os.path.dirname(os.path.abspath(path)))
+        except OSError as e:
+            raise sqlite3.OperationalError(str(e)) from e
+        conn = conns[path] = sqlite3.connect(path, timeout=10)
+    if path not in _sqlite_ready:
+        with _sqlite_ready_lock:
+            if path not in _sqlite_ready:
+                conn.execute("PRAGMA journal_mode=WAL")
+                for statement in schema:
+                    conn.execute(statement)
+                if setup is not None:
+                    setup(conn)
+                conn.commit()
+                _sqlite_ready.add(path)
+    return conn
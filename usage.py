@@ -0,0 +1,186 @@
+import argparse
+import os
+import sqlite3
+import time
+from typing import NamedTuple
+
+from corpus import CACHE_DIR
+from storage import connect_sqlite, load_json_config
+
+# =============================================================================
+# USAGE LEDGER & BUDGETS
+# =============================================================================
+# Every lab call records its prompt/response tokens per session, cohort and
+# module_type in SQLite. Budgets in usage_budgets.json turn usage into a
+# degradation level: as a session or cohort nears its budget, labs first get
+# a smaller retrieval budget, then a shorter output cap, then cached answers
+# only. A quota error from the API puts everyone on cached answers for a
+# short cooldown instead of repeating the failure for every learner.
+
+BUDGETS_PATH = os.environ.get(
+    "USAGE_BUDGETS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "usage_budgets.json")
+)
+LEDGER_PATH = os.environ.get("USAGE_LEDGER_PATH", os.path.join(CACHE_DIR, "usage.sqlite"))
+DEFAULT_COHORT = os.environ.get("COHORT", "default")
+ANONYMOUS_SESSION = "anonymous"
+
+QUOTA_NOTICE = "The AI service is at capacity right now: showing saved answers only."
+NO_CACHED_ANSWER = "No saved answer matches this request yet. Please try again later."
+
+
+class Degradation(NamedTuple):
+    level: int
+    name: str
+    pressure: float
+    k: int = 6
+    max_chars: int = 7000
+    max_output_tokens: int | None = None
+    cached_only: bool = False
+    notice: str = ""
+
+
+# --- Config ---
+_DEFAULT_BUDGETS = {"window_hours": 24, "session_tokens": 0, "anonymous_tokens": 0, "cohort_tokens": 0, "cohorts": [],
+                    "quota_cooldown_s": 120, "levels": []}
+
+
+def load_budgets(path: str = BUDGETS_PATH) -> dict:
+    return load_json_config(path, _DEFAULT_BUDGETS)
+
+
+def _levels(budgets: dict) -> list[Degradation]:
+    # Levels are cumulative: each one inherits the limits of the ones below it.
+    fields = Degradation(0, "full", 0.0)._asdict()
+    levels = [Degradation(**fields)]
+    for n, spec in enumerate(sorted(budgets["levels"], key=lambda s: s["at"]), 1):
+        fields.update({k: v for k, v in spec.items() if k in Degradation._fields})
+        fields.update(level=n, name=spec.get("name", f"level{n}"))
+        levels.append(Degradation(**fields))
+    return levels
+
+
+def levels() -> list[Degradation]:
+    return _levels(load_budgets())
+
+
+def identity(session_id: str, cohort: str) -> tuple[str, str]:
+    # Callers choose their own ids (API headers, ?cohort=), so neither is
+    # trusted as-is: calls without a session id share one anonymous bucket,
+    # and cohorts not listed in the budgets file are charged to the default one.
+    allowed = {*load_budgets()["cohorts"], DEFAULT_COHORT}
+    return session_id or ANONYMOUS_SESSION, cohort if cohort in allowed else DEFAULT_COHORT
+
+
+# --- Ledger ---
+def _connect() -> sqlite3.Connection:
+    return connect_sqlite(
+        LEDGER_PATH,
+        """CREATE TABLE IF NOT EXISTS usage (
+        ts REAL NOT NULL, session_id TEXT NOT NULL, cohort TEXT NOT NULL, module_type TEXT NOT NULL,
+        prompt_tokens INTEGER NOT NULL, output_tokens INTEGER NOT NULL, level INTEGER NOT NULL,
+        cached INTEGER NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS usage_session ON usage (session_id, ts)",
+        "CREATE INDEX IF NOT EXISTS usage_cohort ON usage (cohort, ts)",
+        "CREATE TABLE IF NOT EXISTS quota_events (ts REAL NOT NULL)",
+    )
+
+
+def record_usage(session_id: str, cohort: str, module_type: str, prompt_tokens: int, output_tokens: int,
+                 level: int, cached: bool = False) -> None:
+    session_id, cohort = identity(session_id, cohort)
+    try:
+        with _connect() as conn:
+            conn.execute(
+                "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), session_id, cohort, module_type, prompt_tokens,
+                 output_tokens, level, int(cached)),
+            )
+    except sqlite3.Error:
+        pass
+
+
+def tokens_used(session_id: str, cohort: str, since: float) -> tuple[int, int]:
+    session_id, cohort = identity(session_id, cohort)
+    with _connect() as conn:
+        session = conn.execute(
+            "SELECT COALESCE(SUM(prompt_tokens + output_tokens), 0) FROM usage WHERE session_id = ? AND ts >= ?",
+            (session_id, since),
+        ).fetchone()[0]
+        cohort_total = conn.execute(
+            "SELECT COALESCE(SUM(prompt_tokens + output_tokens), 0) FROM usage WHERE cohort = ? AND ts >= ?",
+            (cohort, since),
+        ).fetchone()[0]
+    return session, cohort_total
+
+
+def note_quota_exhausted() -> None:
+    try:
+        with _connect() as conn:
+            conn.execute("INSERT INTO quota_events VALUES (?)", (time.time(),))
+    except sqlite3.Error:
+        pass
+
+
+def _quota_cooling_down(conn: sqlite3.Connection, cooldown_s: float) -> bool:
+    last = conn.execute("SELECT MAX(ts) FROM quota_events").fetchone()[0]
+    return last is not None and time.time() - last < cooldown_s
+
+
+# --- Budgets ---
+def pressure(session_id: str, cohort: str) -> float:
+    # Fraction of the tighter of the session and cohort budgets used in the window.
+    budgets = load_budgets()
+    since = time.time() - budgets["window_hours"] * 3600
+    try:
+        session, cohort_total = tokens_used(session_id, cohort, since)
+    except sqlite3.Error:
+        return 0.0
+    ratios = [0.0]
+    session_budget = budgets["session_tokens"] if session_id else budgets["anonymous_tokens"] or budgets["session_tokens"]
+    if session_budget:
+        ratios.append(session / session_budget)
+    if budgets["cohort_tokens"]:
+        ratios.append(cohort_total / budgets["cohort_tokens"])
+    return max(ratios)
+
+
+def degradation(session_id: str, cohort: str) -> Degradation:
+    budgets = load_budgets()
+    levels = _levels(budgets)
+    try:
+        with _connect() as conn:
+            cooling = _quota_cooling_down(conn, budgets["quota_cooldown_s"])
+    except sqlite3.Error:
+        cooling = False
+    if cooling:
+        return levels[-1]._replace(name="quota_exhausted", pressure=1.0, cached_only=True, notice=QUOTA_NOTICE)
+
+    p = pressure(session_id, cohort)
+    specs = sorted(budgets["levels"], key=lambda s: s["at"])
+    current = levels[0]
+    for spec, level in zip(specs, levels[1:]):
+        if p >= spec["at"]:
+            current = level
+    return current._replace(pressure=p)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Token usage per cohort / session / module_type.")
+    parser.add_argument("--by", choices=["cohort", "session_id", "module_type"], default="cohort")
+    parser.add_argument("--hours", type=float, default=None, help="Look-back window (default: budget window).")
+    args = parser.parse_args()
+
+    hours = args.hours if args.hours is not None else load_budgets()["window_hours"]
+    with _connect() as conn:
+        rows = conn.execute(
+            f"SELECT {args.by}, COUNT(*), SUM(prompt_tokens), SUM(output_tokens), SUM(cached), MAX(level) "
+            f"FROM usage WHERE ts >= ? GROUP BY {args.by} ORDER BY SUM(prompt_tokens + output_tokens) DESC",
+            (time.time() - hours * 3600,),
+        ).fetchall()
+    print(f"{args.by:<34} {'calls':>6} {'prompt tok':>11} {'output tok':>11} {'cached':>7} {'max level':>9}")
+    for key, calls, prompt_tokens, output_tokens, cached, level in rows:
+        print(f"{key:<34} {calls:>6} {prompt_tokens:>11} {output_tokens:>11} {cached:>7} {level:>9}")
+
+
+if __name__ == "__main__":
+    main()